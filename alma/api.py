@@ -11,35 +11,59 @@ the LIBRARY_CODE and ID_TYPE were all found with the API, but
 they (hopefully) won't ever change, so we don't need to call those API
 endpoints anymore.
 """
-import http
+import hashlib
+import io
 import json
+import logging
+import os
+import random
+import re
+import threading
 import time
 import xml.etree.ElementTree as ET
-from datetime import datetime
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from functools import partial
+from itertools import accumulate
 
 import requests
 from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
 from django.utils.timezone import now, utc
+from requests.adapters import HTTPAdapter
 
+from alma.utils import bulk_update, chunked
+from alma.utils.metrics import registry
 
-def patch_send():
-    old_send = http.client.HTTPConnection.send
-
-    def new_send(self, data):
-        print(data.decode())
-        return old_send(self, data)  # return is not necessary, but never hurts, in case the library is changed
-    http.client.HTTPConnection.send = new_send
-
-patch_send()
-
+logger = logging.getLogger(__name__)
 
 API_KEY = settings.ALMA_API_KEY
 # these magical special values were derived from lots of trial and error and
 # inspecting the results of various API calls
 LIBRARY_CODE = "AVS"
 ID_TYPE = "UNIV_ID"
+BASE_URL = "https://api-na.hosted.exlibrisgroup.com/"
+
+# the HTTP session used to talk to Alma, and the pid of the process that
+# created it (see get_session())
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# the thread pool used to make Alma calls concurrently, and the pid of the
+# process that created it (see get_executor())
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# matches the parts of an endpoint that are IDs, so calls can be grouped in
+# the metrics (and usernames don't end up in them). That is the path segment
+# after one of Alma's collections, or any other segment with a digit in it
+# (except the API version)
+ID_SEGMENT = re.compile(r"(/(?:users|bibs|requests|holdings|items|loans))/[^/]+|/(?!v\d+(?:/|$))[^/]*\d[^/]*")
 
 
 class AlmaError(Exception):
@@ -56,6 +80,12 @@ class AlmaError(Exception):
         return str(self)
 
 
+class ReportTimeout(AlmaError):
+    """
+    Raised when an analytics report doesn't finish before its deadline
+    """
+
+
 def default(obj):
     """
     Helper to handle datetime objects when converting an arbitrary
@@ -67,9 +97,87 @@ def default(obj):
     raise TypeError("Type not serializable")
 
 
+def get_session():
+    """
+    Returns the requests.Session used to talk to Alma. The session keeps a
+    pool of keep-alive connections, so back-to-back calls (like the dozens of
+    create_booking calls a repeating reservation makes) don't each pay for a
+    TCP and TLS handshake.
+
+    There is one session per process. The connection pool is thread-safe, but
+    sockets must not be shared across a fork, so if we find ourselves in a new
+    process, a fresh session is created.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=settings.ALMA_API_POOL_SIZE,
+                    max_retries=settings.ALMA_API_MAX_RETRIES,
+                    # block (rather than open an extra throwaway connection)
+                    # when every connection in the pool is in use
+                    pool_block=True,
+                )
+                session.mount(BASE_URL, adapter)
+                session.headers['connection'] = "keep-alive"
+                _session, _session_pid = session, pid
+
+    return _session
+
+
+def get_executor():
+    """
+    Returns the thread pool used by concurrent_map(). Like the session, there
+    is one per process, and since threads don't survive a fork, a new one is
+    created if we find ourselves in a new process.
+    """
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(max_workers=settings.ALMA_API_MAX_CONCURRENCY)
+                _executor_pid = pid
+
+    return _executor
+
+
+def concurrent_map(func, *iterables):
+    """
+    Like map(), but the calls to `func` are made concurrently, and a list is
+    returned. The results are in the same order as the arguments.
+
+    Every caller shares the same pool of ALMA_API_MAX_CONCURRENCY threads, so
+    that is the cap on the number of Alma calls in flight in this process, no
+    matter how many views are using it. Because of that, `func` must not call
+    concurrent_map() itself (it could deadlock waiting on a thread that will
+    never be free).
+
+    If any call raises an exception, it is re-raised here.
+    """
+    return list(get_executor().map(func, *iterables))
+
+
+def endpoint_name(endpoint):
+    """
+    Converts an endpoint like "almaws/v1/bibs/99902460728301853/requests" to
+    "almaws/v1/bibs/{id}/requests", or "almaws/v1/users/mdj/loans" to
+    "almaws/v1/users/{id}/loans"
+    """
+    return ID_SEGMENT.sub(lambda match: (match.group(1) or "") + "/{id}", endpoint)
+
+
 def request(endpoint, params=None, data=None, method="get"):
     """
     This is a low level wrapper for sending a request to Alma
+
+    Every call is recorded in alma.utils.metrics.registry under the name
+    "alma:<METHOD> <endpoint_name(endpoint)>". If settings.ALMA_API_LOG_BODIES
+    is True, the request and response bodies are logged at the DEBUG level.
     """
     if params is None:
         params = {}
@@ -80,15 +188,33 @@ def request(endpoint, params=None, data=None, method="get"):
         "apikey": API_KEY
     })
 
-    if method == "get":
-        method = requests.get
-    elif method in ["post", "delete"]:
-        method = getattr(requests, method)
+    if method in ["post", "delete"]:
         headers['content-type'] = "application/json"
         if data:
             data = json.dumps(data, default=default)
 
-    response = method("https://api-na.hosted.exlibrisgroup.com/" + endpoint, params=params, data=data, headers=headers)
+    if settings.ALMA_API_LOG_BODIES:
+        logger.debug("%s %s %s", method.upper(), endpoint, data)
+
+    name = "alma:" + method.upper() + " " + endpoint_name(endpoint)
+    start = time.monotonic()
+    try:
+        response = get_session().request(
+            method.upper(),
+            BASE_URL + endpoint,
+            params=params,
+            data=data,
+            headers=headers,
+            timeout=settings.ALMA_API_TIMEOUT,
+        )
+    except requests.RequestException:
+        registry.record(name, time.monotonic() - start, error=True)
+        raise
+
+    registry.record(name, time.monotonic() - start, size=len(response.content), error=response.status_code >= 400)
+
+    if settings.ALMA_API_LOG_BODIES:
+        logger.debug("%s %s", response.status_code, response.content.decode())
 
     # no content to parse, but everything was successful
     if response.status_code == 204:
@@ -97,7 +223,8 @@ def request(endpoint, params=None, data=None, method="get"):
     try:
         content = json.loads(response.content.decode())
     except ValueError:
-        print(response.content.decode())
+        # only log the start of the body, since it could be a huge HTML page
+        logger.warning("%s returned %s with a body that isn't JSON: %r", name, response.status_code, response.content[:500])
         raise
     # wrap 4xx and 5xx status codes in an exception
     if 400 <= response.status_code < 600:
@@ -137,72 +264,259 @@ def get_bib(mms_id):
     return get("almaws/v1/bibs/{mms_id}".format(mms_id=mms_id), params={"expand": "p_avail"})
 
 
-def get_items():
+def iter_report_page(xml):
     """
-    Returns a list of dicts that represent items in Alma
-    WARNING: This only gets the first 1000 rows from the report
+    Incrementally parses one page of an analytics report, so the rows are
+    yielded (and thrown away) one at a time instead of building the whole
+    tree first.
+
+    Yields ("ResumptionToken", token_text) and ("IsFinished", bool) when it
+    gets to those elements, and ("Row", row) for every row, where `row` is a
+    dict mapping the column number to the text in that column
     """
-    data = {
-        # See the following to understand where this magical path came from
-        # https://developers.exlibrisgroup.com/blog/Working-with-Analytics-REST-APIs
-        "path": "/shared/Portland State University/Reports/cg oit avs",
-        "limit": 1000
-    }
+    for event, element in ET.iterparse(io.StringIO(xml)):
+        # strip off the namespace
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "ResumptionToken":
+            yield tag, element.text
+        elif tag == "IsFinished":
+            yield tag, element.text == "true"
+        elif tag == "Row":
+            # the column tag names end with a number (e.g. Column5)
+            yield tag, dict((int(col.tag.rsplit("Column", 1)[-1]), col.text) for col in element)
+            element.clear()
+
+
+def report_delay(attempt):
+    """
+    Returns how many seconds to wait before polling a running report again,
+    after `attempt` polls in a row came back empty. The delay doubles each
+    time (up to ALMA_REPORT_MAX_DELAY) and half of it is random, so a bunch of
+    processes polling at once spread out
+    """
+    delay = min(settings.ALMA_REPORT_MAX_DELAY, settings.ALMA_REPORT_INITIAL_DELAY * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
 
-    # it takes a while for the report to run, so we poll every second to see if it's done
-    while True:
-        response = get("almaws/v1/analytics/reports", data)
-        xml = ET.fromstring(response['anies'][0])
-        if xml.findall("./IsFinished")[0].text == "false":
-            data['token'] = xml.findall("./ResumptionToken")[0]
-            time.sleep(1)
+
+def iter_report(path, limit=1000, timeout=None):
+    """
+    Yields every row of the analytics report at `path` (see
+    iter_report_page() for what a row looks like). The report is fetched
+    `limit` rows at a time (1000 is the most Alma allows), and the rows on
+    each page are yielded as soon as the page arrives.
+
+    Polling the report goes through these states:
+
+    - "starting": we ask Alma to run the report. Alma hands back a
+      ResumptionToken, which is used for every request after this one, so
+      the report isn't run again from scratch
+    - "running": Alma didn't return any rows, so the report is still
+      running. We back off (see report_delay()) and poll again
+    - "paging": we got a page of rows, so we ask for the next one right away
+    - "finished": Alma says there is nothing left
+
+    If the report isn't finished `timeout` seconds (ALMA_REPORT_TIMEOUT by
+    default) after we started, ReportTimeout is raised.
+    """
+    deadline = time.monotonic() + (settings.ALMA_REPORT_TIMEOUT if timeout is None else timeout)
+    token = None
+    # the number of polls in a row that came back empty
+    attempt = 0
+    state = "starting"
+    while state != "finished":
+        if state == "starting":
+            params = {"path": path, "limit": limit}
         else:
-            break
+            params = {"token": token, "limit": limit}
+
+        response = get("almaws/v1/analytics/reports", params)
+        is_finished = False
+        has_rows = False
+        for tag, value in iter_report_page(response['anies'][0]):
+            if tag == "ResumptionToken":
+                token = value
+            elif tag == "IsFinished":
+                is_finished = value
+            else:
+                has_rows = True
+                yield value
+
+        if is_finished:
+            state = "finished"
+            continue
+
+        if token is None:
+            raise AlmaError({"error": "The report didn't return a ResumptionToken", "path": path})
+
+        if has_rows:
+            state = "paging"
+            attempt = 0
+            delay = 0
+        else:
+            state = "running"
+            delay = report_delay(attempt)
+            attempt += 1
+
+        if time.monotonic() + delay > deadline:
+            raise ReportTimeout({"error": "The report didn't finish in time", "path": path, "state": state})
+        time.sleep(delay)
 
+
+def get_items():
+    """
+    Yields a dict for each item in Alma. The rows are yielded as each page of
+    the report arrives, so the whole report is never in memory
+    """
+    # See the following to understand where this magical path came from
+    # https://developers.exlibrisgroup.com/blog/Working-with-Analytics-REST-APIs
+    path = "/shared/Portland State University/Reports/cg oit avs"
     col_names = ["useless", "mms_id", "name", "library_code", "barcode", "description", "item_id", "category"]
-    rows = []
-    for i, row in enumerate(xml.findall(".//{urn:schemas-microsoft-com:xml-analysis:rowset}Row")):
-        item = {}
-        for col in row:
-            # the tag name ends with a number (e.g. Column5), which we use to get the column
-            # name
-            col_index = int(col.tag[-1])
-            item[col_names[col_index]] = col.text
-        rows.append(item)
+    for row in iter_report(path):
+        yield dict((col_names[col_index], text) for col_index, text in row.items())
 
-    return rows
 
+class SyncResult:
+    """
+    What update_items() did. The attributes are sets of Bib mms_ids and Item
+    item_ids, so whatever depends on the Bibs and Items (like the search
+    index) only has to look at what changed.
 
-def update_items():
+    Withdrawn rows are the ones that disappeared from Alma. They aren't
+    deleted (loans and reservations still point at them), but their
+    withdrawn_on is set.
     """
-    Create and/or update all the Bibs and Items in the database so they match Alma
+    def __init__(self):
+        self.rows = 0
+        # seconds spent waiting on Alma, and on the database
+        self.alma_time = 0.0
+        self.db_time = 0.0
+        self.created_bibs = set()
+        self.updated_bibs = set()
+        self.withdrawn_bibs = set()
+        self.created_items = set()
+        self.updated_items = set()
+        self.withdrawn_items = set()
+
+    @property
+    def changed_bibs(self):
+        return self.created_bibs | self.updated_bibs
+
+    @property
+    def changed_items(self):
+        return self.created_items | self.updated_items
+
+    def __bool__(self):
+        return bool(self.changed_bibs or self.changed_items or self.withdrawn_bibs or self.withdrawn_items)
+
+
+def fingerprint(obj, attnames):
     """
-    # TODO delete items that no longer exist?
-    from alma.items.models import Item, Bib
-    with transaction.atomic():
-        for item in get_items():
-            try:
-                bib_obj = Bib.objects.get(pk=item['mms_id'])
-            except Bib.DoesNotExist:
-                bib_obj = Bib(pk=item['mms_id'])
+    Returns a hash of the values of the attributes on obj
+    """
+    return hashlib.sha1(json.dumps([getattr(obj, name) for name in attnames]).encode()).hexdigest()
 
-            bib_obj.name = item['name']
-            bib_obj.save()
 
-            try:
-                item_obj = Item.objects.get(pk=item['item_id'])
-            except Item.DoesNotExist:
-                item_obj = Item(pk=item['item_id'])
+def update_items(batch_size=None, dry_run=False):
+    """
+    Create and/or update all the Bibs and Items in the database so they match
+    Alma, and withdraw the ones that aren't in Alma anymore. Returns a
+    SyncResult, which is also sent with the catalog_synced signal.
 
-            col_names = ["mms_id", "barcode", "description", "category"]
-            for col_name in col_names:
-                try:
-                    setattr(item_obj, col_name, item[col_name])
-                except KeyError:
-                    pass
+    The report is processed `batch_size` (ALMA_SYNC_BATCH_SIZE by default)
+    rows at a time, and each batch is committed on its own.
 
-            item_obj.bib = bib_obj
-            item_obj.save()
+    If `dry_run` is True, the SyncResult says what would have been done, but
+    nothing is written, and the signal isn't sent.
+    """
+    from alma.items.models import Item, Bib
+    from alma.items.signals import catalog_synced
+    result = SyncResult()
+    # the pks of every row in Alma
+    seen = {Bib: set(), Item: set()}
+    batches = chunked(get_items(), batch_size or settings.ALMA_SYNC_BATCH_SIZE)
+    while True:
+        # the report is fetched lazily, so this is where we wait on Alma
+        start = time.monotonic()
+        rows = next(batches, None)
+        result.alma_time += time.monotonic() - start
+        if rows is None:
+            break
+
+        start = time.monotonic()
+        with transaction.atomic():
+            update_item_batch(rows, result, seen, dry_run=dry_run)
+        result.db_time += time.monotonic() - start
+
+    # if the report came back empty, something is wrong, and we definitely
+    # don't want to withdraw everything
+    start = time.monotonic()
+    if result.rows:
+        with transaction.atomic():
+            for model, withdrawn in [(Item, result.withdrawn_items), (Bib, result.withdrawn_bibs)]:
+                stale = model.objects.filter(withdrawn_on=None).exclude(pk__in=seen[model])
+                withdrawn.update(stale.values_list("pk", flat=True))
+                if withdrawn and not dry_run:
+                    model.objects.filter(pk__in=withdrawn).update(withdrawn_on=now())
+    result.db_time += time.monotonic() - start
+
+    if not dry_run:
+        catalog_synced.send(sender=None, result=result)
+    return result
+
+
+def update_item_batch(rows, result, seen, dry_run=False):
+    """
+    Create and/or update the Bibs and Items for a batch of rows from
+    get_items(), recording what was done in the SyncResult. `seen` maps the
+    model to the set of pks found in Alma so far.
+
+    Each row gets a fingerprint of the fields that come from Alma. The
+    existing fingerprints are loaded all at once, and only the rows whose
+    fingerprint changed (or were withdrawn) are written, in bulk (unless
+    `dry_run` is True).
+    """
+    from alma.items.models import Item, Bib
+    result.rows += len(rows)
+    # there is a row for each item, so the same bib can show up many times
+    bibs = OrderedDict()
+    items = OrderedDict()
+    for row in rows:
+        bibs[row['mms_id']] = Bib(mms_id=row['mms_id'], name=row['name'] or "")
+        items[row['item_id']] = Item(
+            item_id=row['item_id'],
+            bib_id=row['mms_id'],
+            barcode=row.get('barcode') or "",
+            description=row.get('description') or "",
+            category=row.get('category') or "",
+        )
+
+    # the bibs have to be saved first, since the items point to them
+    for model, objs, fields, created, updated in [
+        (Bib, bibs, ["name"], result.created_bibs, result.updated_bibs),
+        (Item, items, ["barcode", "description", "category", "bib"], result.created_items, result.updated_items),
+    ]:
+        seen[model].update(objs)
+        # use the attnames, so we don't fetch the related objects
+        attnames = [model._meta.get_field(name).attname for name in fields]
+        existing = dict(
+            (pk, (existing_fingerprint, withdrawn_on))
+            for pk, existing_fingerprint, withdrawn_on in
+            model.objects.filter(pk__in=list(objs)).values_list("pk", "fingerprint", "withdrawn_on")
+        )
+        new = []
+        changed = []
+        for pk, obj in objs.items():
+            obj.fingerprint = fingerprint(obj, attnames)
+            if pk not in existing:
+                new.append(obj)
+            elif existing[pk] != (obj.fingerprint, None):
+                changed.append(obj)
+
+        if not dry_run:
+            model.objects.bulk_create(new)
+            bulk_update(changed, fields + ["fingerprint", "withdrawn_on"])
+        created.update(obj.pk for obj in new)
+        updated.update(obj.pk for obj in changed)
 
 
 def create_booking(username, mms_id, start_date, end_date):
@@ -215,13 +529,16 @@ def create_booking(username, mms_id, start_date, end_date):
         "user_id_type": ID_TYPE,
     }
 
-    return post("almaws/v1/bibs/{mms_id}/requests".format(mms_id=mms_id), params=params, data={
-        "request_type": "BOOKING",
-        "pickup_location_type": "LIBRARY",
-        "pickup_location_library": LIBRARY_CODE,
-        "booking_start_date": start_date,
-        "booking_end_date": end_date,
-    })
+    try:
+        return post("almaws/v1/bibs/{mms_id}/requests".format(mms_id=mms_id), params=params, data={
+            "request_type": "BOOKING",
+            "pickup_location_type": "LIBRARY",
+            "pickup_location_library": LIBRARY_CODE,
+            "booking_start_date": start_date,
+            "booking_end_date": end_date,
+        })
+    finally:
+        invalidate_availability(mms_id)
 
 
 def delete_booking(request_id, mms_id):
@@ -229,17 +546,54 @@ def delete_booking(request_id, mms_id):
     Deletes a booking with the specified request_id for the mms_id. (Why you
     have to pass in the mms_id too is beyond me).
     """
-    return delete("almaws/v1/bibs/{mms_id}/requests/{request_id}".format(request_id=request_id, mms_id=mms_id))
+    try:
+        return delete("almaws/v1/bibs/{mms_id}/requests/{request_id}".format(request_id=request_id, mms_id=mms_id))
+    finally:
+        invalidate_availability(mms_id)
+
+
+def availability_cache_key(mms_id):
+    return "alma:availability:" + str(mms_id)
 
 
 def get_availability(mms_id, days):
     """
     Returns the intervals of time the mms_id is not available, in the coming `days` days.
+
+    The response is cached for ALMA_AVAILABILITY_TTL seconds, and any call
+    whose window fits inside the cached window is answered from the cache. To
+    make that likely, at least ALMA_AVAILABILITY_MIN_DAYS days are fetched
+    from Alma. The extra days don't hurt anything, since callers only care
+    about whether their intervals overlap what's booked.
+
+    Our own writes (create_booking, delete_booking, create_loan and
+    return_loan) invalidate the cache for the bib they touch.
     """
-    return get("almaws/v1/bibs/{mms_id}/booking-availability".format(mms_id=mms_id), {
+    key = availability_cache_key(mms_id)
+    # the cached window starts when the response was fetched, so what matters
+    # is whether it ends after our window does
+    cached = cache.get(key)
+    if cached is not None and cached['until'] >= now() + timedelta(days=days):
+        registry.incr("availability_cache:hit")
+        return cached['response']
+
+    registry.incr("availability_cache:miss")
+    days = max(days, settings.ALMA_AVAILABILITY_MIN_DAYS)
+    fetched_on = now()
+    response = get("almaws/v1/bibs/{mms_id}/booking-availability".format(mms_id=mms_id), {
         "period": days,
         "period_type": "days",
     })
+    cache.set(key, {"until": fetched_on + timedelta(days=days), "response": response}, settings.ALMA_AVAILABILITY_TTL)
+    return response
+
+
+def invalidate_availability(mms_id):
+    """
+    Forget the cached availability for the mms_id, so the next call to
+    get_availability() goes to Alma
+    """
+    cache.delete(availability_cache_key(mms_id))
 
 
 def create_loan(username, barcode):
@@ -254,17 +608,50 @@ def create_loan(username, barcode):
         "circ_desk": {"value": "DEFAULT_CIRC_DESK"},
         "library": {"value": LIBRARY_CODE},
     }
-    return post("almaws/v1/users/{user_id}/loans".format(user_id=username), params=params, data=data)
-
-
-def return_loan(mms_id, item_id):
+    from alma.items.models import Item
+    try:
+        response = post("almaws/v1/users/{user_id}/loans".format(user_id=username), params=params, data=data)
+        # the loan says which holding the item is in, so returning it won't
+        # have to look that up
+        if response.get("holding_id"):
+            Item.objects.filter(barcode=barcode).update(holding_id=response["holding_id"])
+        return response
+    finally:
+        for mms_id in Item.objects.filter(barcode=barcode).values_list("bib_id", flat=True):
+            invalidate_availability(mms_id)
+
+
+def return_loan(mms_id, item_id, holding_id=None):
     """
     Checks in, un-loans, or returns (depending on your preferred terminology)
     an item with the specified mms_id and item_id
+
+    If the holding_id saved on the Item is passed in, this is one Alma call.
+    Otherwise (or if Alma rejects it, because the item moved) the holdings are
+    looked up, and the holding_id is saved on the Item for next time
+    """
+    try:
+        if holding_id:
+            try:
+                return scan_in(mms_id, holding_id, item_id)
+            except AlmaError:
+                logger.info("Scanning in item %s to holding %s failed. Looking up its holding", item_id, holding_id)
+
+        holding_id = refresh_holding_id(mms_id, item_id)
+        return scan_in(mms_id, holding_id, item_id)
+    finally:
+        invalidate_availability(mms_id)
+
+
+def refresh_holding_id(mms_id, item_id):
+    """
+    Gets the holding_id for the item from Alma, and saves it on the Item
     """
+    from alma.items.models import Item
     # we assume the first holding is where we want the item returned
     holding_id = get_holdings(mms_id)["holding"][0]["holding_id"]
-    return scan_in(mms_id, holding_id, item_id)
+    Item.objects.filter(pk=item_id).update(holding_id=holding_id)
+    return holding_id
 
 
 def get_holdings(mms_id):
@@ -291,34 +678,33 @@ def is_available(mms_id, intervals):
     `intervals` is assumed to be a list of two-tuples containing start and end
     datetime objects.
     """
-    end = intervals[-1].end
+    end = max(interval[1] for interval in intervals)
     days = (end - now()).days + 1
     response = get_availability(mms_id, days)
-    # nothing got booked
-    if response["booking_availability"] is None:
-        response['booking_availability'] = []
-    # O(n*m) algorithm since I'm worn out today
+    # parse the booked windows once (the response is None if nothing got
+    # booked), and sort them by when they start
+    booked = sorted(
+        (parse_alma_datetime(availability['from_time']), parse_alma_datetime(availability['to_time']))
+        for availability in response['booking_availability'] or []
+    )
+    starts = [start for start, end in booked]
+    # latest_ends[i] is the latest end time of booked[0] through booked[i]
+    latest_ends = list(accumulate((end for start, end in booked), max))
+
     for interval in intervals:
-        for availability in response['booking_availability']:
-            start = parse_alma_datetime(availability['from_time'])
-            end = parse_alma_datetime(availability['to_time'])
-            if start < interval[1] and end > interval[0]:
-                yield False
-                break
-        else:
-            yield True
+        # every booked window before index i starts before this interval
+        # ends. If any of them ends after this interval starts, they overlap
+        i = bisect_left(starts, interval[1])
+        yield not (i and latest_ends[i-1] > interval[0])
 
 
 def parse_alma_datetime(dt):
     """
     Converts an alma datetime string to an aware datetime object
     """
-    try:
-        dt = datetime.strptime(dt+"+0000", "%Y-%m-%dT%H:%M:%Sz%z")
-    except ValueError:
-        dt = datetime.strptime(dt+"+0000", "%Y-%m-%dT%H:%M:%S.%fz%z")
-
-    return dt
+    if "." in dt:
+        return datetime.strptime(dt+"+0000", "%Y-%m-%dT%H:%M:%S.%fz%z")
+    return datetime.strptime(dt+"+0000", "%Y-%m-%dT%H:%M:%Sz%z")
 
 #
 # Some examples
@@ -1 +1,3 @@
 from .indexes import *  # noqa
+# connect the catalog_synced receivers
+from . import utils  # noqa isort:skip
@@ -0,0 +1,115 @@
+"""
+An in-process index of the Bibs and Items, so autocomplete doesn't have to
+go to Elasticsearch (which is slow, or down, sometimes) for the common
+cases: scanning a barcode, or typing the beginning of a Bib's name.
+
+The equipment catalog is small, so everything is kept in sorted lists, and
+prefix lookups are done with bisect.
+"""
+import re
+import threading
+from bisect import bisect_left
+
+from .models import Bib, Item
+from .utils import get_catalog_version
+
+
+def tokenize(text):
+    """
+    Lowercases the text, and splits it into words (underscores split words
+    too, just like the analyzer in indexes.py)
+    """
+    return re.findall(r"[^\W_]+", text.lower())
+
+
+def prefix_range(keys, prefix):
+    """
+    Returns the slice of the sorted list `keys` that start with `prefix`
+    """
+    return slice(bisect_left(keys, prefix), bisect_left(keys, prefix + "\uffff"))
+
+
+class CatalogIndex:
+    def __init__(self, bibs, items):
+        """
+        `bibs` is an iterable of (mms_id, name) tuples, and `items` is an
+        iterable of (barcode, name, description, category) tuples
+        """
+        self.bibs = dict(bibs)
+        self.mms_ids = sorted(self.bibs)
+
+        items = sorted(items)
+        self.barcodes = [item[0] for item in items]
+        self.items = [{
+            "barcode": barcode,
+            "name": name,
+            "description": description,
+            "category": category,
+            "type": "ITEM",
+        } for barcode, name, description, category in items]
+        self.items_by_barcode = dict(zip(self.barcodes, self.items))
+
+        # every word in every Bib name, paired with the Bib's mms_id
+        words = sorted(set((word, mms_id) for mms_id, name in self.bibs.items() for word in tokenize(name)))
+        self.words = [word for word, mms_id in words]
+        self.word_mms_ids = [mms_id for word, mms_id in words]
+
+    @classmethod
+    def load(cls):
+        """Builds the index from the Bibs and Items in the database"""
+        bibs = Bib.objects.filter(withdrawn_on=None).values_list("mms_id", "name")
+        items = Item.objects.filter(withdrawn_on=None).values_list("barcode", "bib__name", "description", "category")
+        return cls(bibs, items)
+
+    def bib_result(self, mms_id):
+        return {"mms_id": mms_id, "name": self.bibs[mms_id], "type": "BIB"}
+
+    def search(self, query, limit):
+        """
+        Returns the same list of dicts as alma.items.views.search():
+
+        - Items whose barcode starts with the query, or equals one of its words
+        - Bibs whose mms_id is one of the words in the query (these come first,
+          like the boost in the Elasticsearch query)
+        - Bibs where every word in the query is the start of a word in the name
+        """
+        query = query.strip()
+        words = tokenize(query)
+        results = []
+
+        barcodes = set(self.barcodes[prefix_range(self.barcodes, query)][:limit]) if query else set()
+        barcodes.update(word for word in words if word in self.items_by_barcode)
+        results.extend(self.items_by_barcode[barcode] for barcode in sorted(barcodes)[:limit])
+
+        bibs = [word for word in words if word in self.bibs]
+        if words:
+            matches = None
+            for word in words:
+                mms_ids = set(self.word_mms_ids[prefix_range(self.words, word)])
+                matches = mms_ids if matches is None else matches & mms_ids
+            bibs.extend(sorted(matches - set(bibs), key=lambda mms_id: self.bibs[mms_id]))
+        results.extend(self.bib_result(mms_id) for mms_id in bibs[:limit])
+
+        return results
+
+
+_index = None
+_version = None
+_lock = threading.Lock()
+
+
+def get_catalog_index():
+    """
+    Returns the CatalogIndex for this process. It is reloaded whenever the
+    catalog version (see alma.items.utils) changed, which means a sync changed
+    something. Checking the version is one cache lookup, so it is done every
+    time (otherwise stale results could get cached under the new version's
+    autocomplete cache keys)
+    """
+    global _index, _version
+    version = get_catalog_version()
+    with _lock:
+        if _index is None or version != _version:
+            _index = CatalogIndex.load()
+            _version = version
+        return _index
@@ -1,7 +1,20 @@
+import logging
+from itertools import chain
+
+from django.conf import settings
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils.timezone import now
 from elasticmodels import Index, StringField
-from elasticsearch_dsl import analyzer, token_filter, tokenizer
+from elasticsearch import ElasticsearchException
+from elasticsearch.helpers import bulk, parallel_bulk
+from elasticsearch_dsl import Completion, analyzer, token_filter, tokenizer
+from elasticsearch_dsl.connections import connections
 
 from .models import Bib, Item
+from .signals import catalog_synced
+
+logger = logging.getLogger(__name__)
 
 # override the default analyzer for ES to use an ngram filter that breaks words using
 # the standard tokenizer. Allow words to be broken up with underscores
@@ -33,8 +46,21 @@ custom_analyzer = analyzer(
 )
 
 
+def name_inputs(name):
+    """
+    Returns the inputs for the completion suggester for a name. Completions
+    only match from the beginning of an input, so every word in the name
+    starts an input, e.g. "Firewire cable" => ["Firewire cable", "cable"]
+    """
+    words = name.split()
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
 class BibIndex(Index):
     mms_id = StringField(analyzer="keyword")
+    # an FST backed field for fast prefix lookups on the name. The payload
+    # holds the mms_id, so the suggestions can be used without a search
+    suggest = Completion(analyzer="simple", search_analyzer="simple", payloads=True)
 
     class Meta:
         model = Bib
@@ -43,6 +69,16 @@ class BibIndex(Index):
             "name"
         ]
 
+    def prepare_suggest(self, instance):
+        return {
+            "input": name_inputs(instance.name),
+            "output": instance.name,
+            "payload": {"mms_id": instance.mms_id},
+        }
+
+    def get_queryset(self, **kwargs):
+        return super().get_queryset().filter(withdrawn_on=None)
+
 
 class ItemIndex(Index):
     item_id = StringField(analyzer="keyword")
@@ -51,6 +87,9 @@ class ItemIndex(Index):
     # Elasticsearch-dsl knows about it. Because it becomes the default
     # analyzer, we don't have to use the analyizer elsewhere
     name = StringField(analyzer=custom_analyzer)
+    # for prefix lookups on the barcode. The payload has everything
+    # autocomplete needs to display the item
+    suggest = Completion(analyzer="keyword", search_analyzer="keyword", payloads=True)
 
     class Meta:
         doc_type = "item"
@@ -63,5 +102,191 @@ class ItemIndex(Index):
     def prepare_name(self, instance):
         return instance.bib.name
 
+    def prepare_suggest(self, instance):
+        return {
+            "input": [instance.barcode],
+            "output": instance.barcode,
+            "payload": {
+                "barcode": instance.barcode,
+                "name": instance.bib.name,
+                "description": instance.description,
+                "category": instance.category,
+            },
+        }
+
     def get_queryset(self, **kwargs):
-        return super().get_queryset().select_related("bib")
+        return super().get_queryset().filter(withdrawn_on=None).select_related("bib")
+
+
+def index_actions(index, doc_type, objects, index_name=None):
+    """
+    Yields the bulk API actions to (re)index the model instances in
+    `objects`, in the `index_name` index (the alma index by default)
+    """
+    for instance in objects:
+        yield {
+            "_op_type": "index",
+            "_index": index_name or settings.ELASTICSEARCH_CONNECTIONS['default']['index_name'],
+            "_type": doc_type,
+            "_id": instance.pk,
+            "_source": index.prepare(instance),
+        }
+
+
+def delete_actions(doc_type, ids):
+    """
+    Yields the bulk API actions to remove the documents with the ids
+    """
+    for pk in ids:
+        yield {
+            "_op_type": "delete",
+            "_index": settings.ELASTICSEARCH_CONNECTIONS['default']['index_name'],
+            "_type": doc_type,
+            "_id": pk,
+        }
+
+
+def update_documents(bib_ids=(), item_ids=(), deleted_bib_ids=(), deleted_item_ids=()):
+    """
+    Reindexes just the Bibs and Items with the given ids, and removes the
+    deleted ones from the index. Everything goes through the bulk API,
+    ELASTICSEARCH_CHUNK_SIZE documents at a time, so the cost depends on how
+    much changed, not how big the catalog is.
+
+    Returns the number of documents that were indexed or deleted.
+    """
+    bib_index = BibIndex()
+    item_index = ItemIndex()
+    bibs = bib_index.get_queryset().filter(pk__in=list(bib_ids))
+    # the item documents include the name of their bib (see
+    # ItemIndex.prepare_name), so they have to be reindexed when their bib is
+    items = item_index.get_queryset().filter(Q(pk__in=list(item_ids)) | Q(bib_id__in=list(bib_ids)))
+    actions = chain(
+        index_actions(bib_index, "bib", bibs.iterator()),
+        index_actions(item_index, "item", items.iterator()),
+        delete_actions("bib", deleted_bib_ids),
+        delete_actions("item", deleted_item_ids),
+    )
+    count, errors = bulk(
+        connections.get_connection(),
+        actions,
+        chunk_size=settings.ELASTICSEARCH_CHUNK_SIZE,
+        raise_on_error=False,
+    )
+    for error in errors:
+        # it's fine if a document we're removing was never indexed
+        if error.get("delete", {}).get("status") != 404:
+            logger.error("Could not update the search index: %s", error)
+
+    return count
+
+
+def iter_queryset(queryset, chunk_size):
+    """
+    Yields everything in the queryset, `chunk_size` rows at a time, so the
+    whole table is never in memory. QuerySet.iterator() doesn't help here,
+    since psycopg2 fetches the whole result set anyway, so this pages through
+    the table by primary key instead (which is just as cheap)
+    """
+    queryset = queryset.order_by("pk")
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        for obj in chunk:
+            yield obj
+        # a short chunk means we reached the end of the table
+        if len(chunk) < chunk_size:
+            break
+        chunk = list(queryset.filter(pk__gt=chunk[-1].pk)[:chunk_size])
+
+
+def index_body():
+    """
+    Returns the settings and mappings needed to create the alma index
+    """
+    mappings = {}
+    for index in [BibIndex(), ItemIndex()]:
+        mappings.update(index._doc_type.mapping.to_dict())
+
+    return {
+        "settings": {
+            "analysis": custom_analyzer.get_analysis_definition(),
+            # there's no point refreshing while the index is being built
+            "refresh_interval": "-1",
+        },
+        "mappings": mappings,
+    }
+
+
+def rebuild_index():
+    """
+    Rebuilds the whole alma index without any downtime.
+
+    The "alma" index is really an alias. A new, versioned index (like
+    alma-20150830101010) is created, and every Bib and Item is streamed into
+    it with the bulk API, using ELASTICSEARCH_REBUILD_THREADS threads. Once it
+    is done, the alias is switched to the new index (atomically), and the old
+    index is deleted. Searches keep using the old index the whole time.
+
+    Returns the name of the new index.
+    """
+    es = connections.get_connection()
+    alias = settings.ELASTICSEARCH_CONNECTIONS['default']['index_name']
+    new_index = alias + "-" + now().strftime("%Y%m%d%H%M%S")
+    es.indices.create(index=new_index, body=index_body())
+
+    bib_index = BibIndex()
+    item_index = ItemIndex()
+    actions = chain(
+        index_actions(bib_index, "bib", iter_queryset(bib_index.get_queryset(), settings.ELASTICSEARCH_CHUNK_SIZE), new_index),
+        index_actions(item_index, "item", iter_queryset(item_index.get_queryset(), settings.ELASTICSEARCH_CHUNK_SIZE), new_index),
+    )
+    try:
+        # parallel_bulk is lazy, so we have to consume it
+        for ok, info in parallel_bulk(es, actions, thread_count=settings.ELASTICSEARCH_REBUILD_THREADS, chunk_size=settings.ELASTICSEARCH_CHUNK_SIZE):
+            pass
+        es.indices.put_settings(index=new_index, body={"refresh_interval": "1s"})
+        es.indices.refresh(index=new_index)
+    except:  # noqa
+        es.indices.delete(index=new_index)
+        raise
+
+    if es.indices.exists_alias(name=alias):
+        old_indexes = list(es.indices.get_alias(name=alias))
+    else:
+        old_indexes = []
+        # before the first rebuild, the alma index is a real index, and it
+        # has to be deleted before there can be an alias with the same name.
+        # This is the only time searches will come back empty
+        if es.indices.exists(index=alias):
+            es.indices.delete(index=alias)
+
+    es.indices.update_aliases(body={"actions": [
+        {"remove": {"index": old_index, "alias": alias}} for old_index in old_indexes
+    ] + [
+        {"add": {"index": new_index, "alias": alias}}
+    ]})
+    for old_index in old_indexes:
+        es.indices.delete(index=old_index)
+
+    return new_index
+
+
+@receiver(catalog_synced)
+def update_documents_after_sync(sender, result, **kwargs):
+    """
+    Pushes whatever alma.api.update_items() changed to the index
+    """
+    if not result:
+        return
+
+    try:
+        update_documents(
+            bib_ids=result.changed_bibs,
+            item_ids=result.changed_items,
+            deleted_bib_ids=result.withdrawn_bibs,
+            deleted_item_ids=result.withdrawn_items,
+        )
+    except ElasticsearchException:
+        # the database is already up to date, so don't fail the sync. The
+        # next full rebuild of the index will fix things
+        logger.exception("Could not update the search index after syncing the catalog")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from alma.items.indexes import rebuild_index
+from alma.utils import LockNotAcquired, advisory_lock
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the alma search index into a new index, and then swaps the alias to point at it"
+
+    def handle(self, *args, **options):
+        try:
+            with advisory_lock("alma.items.rebuild_search_index"):
+                # a sync during the rebuild would update the old index (the
+                # alias still points at it), and its changes would be lost
+                # when the old index is deleted. So no syncing until we're done
+                with advisory_lock("alma.items.sync_items"):
+                    new_index = rebuild_index()
+        except LockNotAcquired as e:
+            if e.args[0] == "alma.items.sync_items":
+                raise CommandError("A sync is running. Try again once it is done")
+            raise CommandError("Another rebuild is already running")
+
+        self.stdout.write("The alias now points at " + new_index)
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from alma.api import update_items
+from alma.utils import LockNotAcquired, advisory_lock
+
+
+class Command(BaseCommand):
+    help = "Syncs the Bibs and Items in the database with the analytics report in Alma"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="The number of rows to process (and commit) at a time")
+        parser.add_argument("--dry-run", action="store_true", default=False, help="Report what would change, without changing anything")
+
+    def handle(self, *args, batch_size, dry_run, **options):
+        start = time.monotonic()
+        # two syncs at once (i.e. overlapping cron jobs) would fight over the
+        # same rows, and both withdraw things. A search index rebuild holds
+        # this lock too (see rebuild_search_index)
+        try:
+            with advisory_lock("alma.items.sync_items"):
+                result = update_items(batch_size=batch_size, dry_run=dry_run)
+        except LockNotAcquired:
+            raise CommandError("Another sync (or a search index rebuild) is already running")
+        elapsed = time.monotonic() - start
+
+        verbosity = int(options.get("verbosity", 1))
+        if dry_run:
+            self.stdout.write("Dry run. Nothing was changed.")
+        self.stdout.write("{0} rows in {1:.1f}s ({2:.1f} rows/sec)".format(result.rows, elapsed, result.rows / elapsed if elapsed else 0))
+        self.stdout.write("Alma: {0:.1f}s, DB: {1:.1f}s".format(result.alma_time, result.db_time))
+        for label, bibs, items in [
+            ("Inserted", result.created_bibs, result.created_items),
+            ("Updated", result.updated_bibs, result.updated_items),
+            ("Withdrawn", result.withdrawn_bibs, result.withdrawn_items),
+        ]:
+            self.stdout.write("{0}: {1} bibs, {2} items".format(label, len(bibs), len(items)))
+            # show the actual diff when asked to
+            if verbosity > 1:
+                for pk in sorted(bibs):
+                    self.stdout.write("  bib " + pk)
+                for pk in sorted(items):
+                    self.stdout.write("  item " + pk)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bib',
+            name='fingerprint',
+            field=models.CharField(default='', editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='bib',
+            name='withdrawn_on',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='fingerprint',
+            field=models.CharField(default='', editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='withdrawn_on',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
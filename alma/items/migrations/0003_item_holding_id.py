@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0002_sync_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='holding_id',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+    ]
@@ -10,6 +10,11 @@ class Bib(models.Model):
     """
     mms_id = models.CharField(max_length=255, primary_key=True)
     name = models.CharField(max_length=255)
+    # a hash of the fields that come from Alma, so syncing only has to write
+    # the rows that changed
+    fingerprint = models.CharField(max_length=40, default="", editable=False)
+    # set when the bib disappears from Alma
+    withdrawn_on = models.DateTimeField(null=True, default=None)
 
     class Meta:
         db_table = "bib"
@@ -26,6 +31,15 @@ class Item(models.Model):
     # this could be made into a foreign key, but this table is just caching
     # what's in Alma
     category = models.CharField(max_length=255)
+    # the Alma holding the item is returned to. It isn't in the analytics
+    # report, so it is saved the first time we need it (see
+    # alma.api.return_loan)
+    holding_id = models.CharField(max_length=255, default="", editable=False)
+    # a hash of the fields that come from Alma, so syncing only has to write
+    # the rows that changed
+    fingerprint = models.CharField(max_length=40, default="", editable=False)
+    # set when the item disappears from Alma
+    withdrawn_on = models.DateTimeField(null=True, default=None)
 
     class Meta:
         db_table = "item"
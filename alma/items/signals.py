@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# sent after alma.api.update_items() syncs the Bibs and Items with Alma.
+# `result` is the alma.api.SyncResult describing what changed
+catalog_synced = Signal(providing_args=["result"])
@@ -0,0 +1,257 @@
+import json
+from contextlib import contextmanager
+from io import StringIO
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, TestCase
+from elasticsearch.exceptions import ElasticsearchException
+from model_mommy.mommy import make, prepare
+
+from alma.api import SyncResult
+from alma.users.models import User
+from alma.utils import LockNotAcquired
+
+from .catalog import CatalogIndex, get_catalog_index
+from .indexes import iter_queryset, name_inputs, rebuild_index, update_documents
+from .models import Bib, Item
+from .signals import catalog_synced
+from .utils import bump_catalog_version, cached_autocomplete
+from .views import autocomplete, suggest_search
+
+
+class SyncItemsCommandTest(TestCase):
+    def test_report(self):
+        result = SyncResult()
+        result.rows = 3
+        result.created_items = {"1", "2"}
+        out = StringIO()
+        with patch("alma.items.management.commands.sync_items.update_items", return_value=result) as update_items:
+            call_command("sync_items", batch_size=10, dry_run=True, stdout=out)
+
+        update_items.assert_called_once_with(batch_size=10, dry_run=True)
+        self.assertIn("Dry run", out.getvalue())
+        self.assertIn("Inserted: 0 bibs, 2 items", out.getvalue())
+
+    def test_only_one_sync_at_a_time(self):
+        with patch("alma.items.management.commands.sync_items.advisory_lock") as lock:
+            lock.return_value.__enter__.side_effect = LockNotAcquired("alma.items.sync_items")
+            with patch("alma.items.management.commands.sync_items.update_items") as update_items:
+                self.assertRaises(CommandError, call_command, "sync_items", stdout=StringIO())
+
+        self.assertFalse(update_items.called)
+
+
+class RebuildSearchIndexCommandTest(TestCase):
+    def test_no_rebuild_during_a_sync(self):
+        @contextmanager
+        def advisory_lock(name):
+            # a sync is running
+            if name == "alma.items.sync_items":
+                raise LockNotAcquired(name)
+            yield
+
+        with patch("alma.items.management.commands.rebuild_search_index.advisory_lock", advisory_lock):
+            with patch("alma.items.management.commands.rebuild_search_index.rebuild_index") as rebuild_index:
+                with self.assertRaisesRegex(CommandError, "sync"):
+                    call_command("rebuild_search_index", stdout=StringIO())
+
+        self.assertFalse(rebuild_index.called)
+
+
+class UpdateDocumentsTest(TestCase):
+    def test_only_the_changes_are_sent(self):
+        camera = Bib.objects.create(mms_id="1", name="Camera")
+        tripod = Bib.objects.create(mms_id="2", name="Tripod")
+        Item.objects.create(item_id="10", bib=camera, barcode="123")
+        Item.objects.create(item_id="11", bib=tripod, barcode="124")
+        Item.objects.create(item_id="12", bib=tripod, barcode="125")
+
+        def fake_bulk(client, actions, **kwargs):
+            self.actions = list(actions)
+            return len(self.actions), []
+
+        with patch("alma.items.indexes.bulk", side_effect=fake_bulk):
+            update_documents(bib_ids={"1"}, item_ids={"11"}, deleted_item_ids={"13"})
+
+        sent = sorted((action['_op_type'], action['_type'], action['_id']) for action in self.actions)
+        self.assertEqual(sent, [
+            ("delete", "item", "13"),
+            ("index", "bib", "1"),
+            # the camera's item is reindexed since it has the bib's name in it
+            ("index", "item", "10"),
+            ("index", "item", "11"),
+        ])
+        item_10 = [action for action in self.actions if action['_id'] == "10"][0]
+        self.assertEqual(item_10['_source']['name'], "Camera")
+
+    def test_sync_updates_the_index(self):
+        result = SyncResult()
+        result.updated_items = {"10"}
+        result.withdrawn_bibs = {"2"}
+        with patch("alma.items.indexes.update_documents") as update:
+            catalog_synced.send(sender=None, result=result)
+
+        update.assert_called_once_with(bib_ids=set(), item_ids={"10"}, deleted_bib_ids={"2"}, deleted_item_ids=set())
+
+
+class RebuildIndexTest(TestCase):
+    def test_iter_queryset(self):
+        for i in range(5):
+            Bib.objects.create(mms_id=str(i), name="foo")
+
+        with self.assertNumQueries(3):
+            self.assertEqual([bib.pk for bib in iter_queryset(Bib.objects.all(), 2)], ["0", "1", "2", "3", "4"])
+
+        # when the last chunk is full, one more (empty) query is needed to
+        # know it was the last
+        with self.assertNumQueries(2):
+            self.assertEqual(len(list(iter_queryset(Bib.objects.all(), 5))), 5)
+
+    def test_alias_is_swapped(self):
+        es = Mock()
+        es.indices.exists_alias.return_value = True
+        es.indices.get_alias.return_value = {"alma-1": {}}
+        with patch("alma.items.indexes.connections.get_connection", return_value=es), \
+                patch("alma.items.indexes.index_body", return_value={}), \
+                patch("alma.items.indexes.parallel_bulk", return_value=[]):
+            new_index = rebuild_index()
+
+        self.assertTrue(new_index.startswith("alma-"))
+        es.indices.create.assert_called_once_with(index=new_index, body={})
+        es.indices.update_aliases.assert_called_once_with(body={"actions": [
+            {"remove": {"index": "alma-1", "alias": "alma"}},
+            {"add": {"index": new_index, "alias": "alma"}},
+        ]})
+        es.indices.delete.assert_called_once_with(index="alma-1")
+
+
+class AutocompleteTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_one_multi_search_request(self):
+        es = Mock()
+        es.msearch.return_value = {"responses": [
+            {"hits": {"hits": [{"_source": {"barcode": "123", "name": "Camera", "description": "A camera", "category": "Video"}}]}},
+            {"hits": {"hits": [{"_source": {"mms_id": "1", "name": "Camera"}}]}},
+        ]}
+        request = RequestFactory().get("/items/autocomplete", {"query": "cam"})
+        request.user = prepare(User)
+        # nothing is found in memory, so Elasticsearch is searched
+        with patch("alma.items.views.get_catalog_index", return_value=CatalogIndex([], [])):
+            with patch("alma.items.views.connections.get_connection", return_value=es):
+                response = autocomplete(request)
+
+        self.assertEqual(es.msearch.call_count, 1)
+        body = es.msearch.call_args[1]['body']
+        self.assertEqual([header['type'] for header in body[::2]], ["item", "bib"])
+        # only the fields we use are fetched
+        self.assertEqual(body[3]['_source'], ["mms_id", "name"])
+        self.assertEqual(json.loads(response.content.decode()), [
+            {"barcode": "123", "name": "Camera", "description": "A camera", "category": "Video", "type": "ITEM"},
+            {"mms_id": "1", "name": "Camera", "type": "BIB"},
+        ])
+
+    def test_results_are_cached_until_the_catalog_changes(self):
+        search = Mock(return_value=[{"mms_id": "1", "name": "Camera", "type": "BIB"}])
+        self.assertEqual(cached_autocomplete("Camera", search), search.return_value)
+        # the query is normalized
+        self.assertEqual(cached_autocomplete("  camera ", search), search.return_value)
+        self.assertEqual(search.call_count, 1)
+
+        # a sync that changes nothing doesn't invalidate anything
+        catalog_synced.send(sender=None, result=SyncResult())
+        cached_autocomplete("camera", search)
+        self.assertEqual(search.call_count, 1)
+
+        result = SyncResult()
+        result.updated_bibs = {"1"}
+        with patch("alma.items.indexes.update_documents"):
+            catalog_synced.send(sender=None, result=result)
+        cached_autocomplete("camera", search)
+        self.assertEqual(search.call_count, 2)
+
+    def test_suggest_search(self):
+        es = Mock()
+        es.msearch.return_value = {"responses": [
+            {"hits": {"hits": []}, "suggest": {"suggestions": [{"options": [
+                {"text": "123", "payload": {"barcode": "123", "name": "Camera", "description": "A camera", "category": "Video"}},
+            ]}]}},
+            # the exact mms_id match comes first, and isn't repeated
+            {"hits": {"hits": [{"_source": {"mms_id": "2", "name": "Camera bag"}}]}, "suggest": {"suggestions": [{"options": [
+                {"text": "Camera", "payload": {"mms_id": "1"}},
+                {"text": "Camera bag", "payload": {"mms_id": "2"}},
+            ]}]}},
+        ]}
+        with patch("alma.items.views.connections.get_connection", return_value=es):
+            results = suggest_search("cam")
+
+        body = es.msearch.call_args[1]['body']
+        self.assertEqual(body[3]['suggest']['suggestions']['completion']['field'], "suggest")
+        self.assertEqual(results, [
+            {"barcode": "123", "name": "Camera", "description": "A camera", "category": "Video", "type": "ITEM"},
+            {"mms_id": "2", "name": "Camera bag", "type": "BIB"},
+            {"mms_id": "1", "name": "Camera", "type": "BIB"},
+        ])
+
+    def test_name_inputs(self):
+        self.assertEqual(name_inputs("Firewire  cable"), ["Firewire cable", "cable"])
+
+
+class CatalogIndexTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.index = CatalogIndex(
+            [("1", "Camera"), ("2", "Camera bag"), ("3", "Firewire_cable")],
+            [("123", "Camera", "A camera", "Video"), ("1234", "Camera", "Another camera", "Video"), ("999", "Tripod", "", "Video")],
+        )
+
+    def test_barcodes(self):
+        self.assertEqual([result['barcode'] for result in self.index.search("123", 10)], ["123", "1234"])
+        self.assertEqual(self.index.search("999", 10), [
+            {"barcode": "999", "name": "Tripod", "description": "", "category": "Video", "type": "ITEM"},
+        ])
+
+    def test_bib_names(self):
+        self.assertEqual([result['mms_id'] for result in self.index.search("cam", 10)], ["1", "2"])
+        self.assertEqual([result['mms_id'] for result in self.index.search("Camera b", 10)], ["2"])
+        self.assertEqual([result['mms_id'] for result in self.index.search("cable", 10)], ["3"])
+        self.assertEqual(self.index.search("tripod", 10), [])
+
+    def test_exact_mms_id_comes_first(self):
+        results = self.index.search("Camera bag (MMS ID: 2)", 10)
+        self.assertEqual(results[0], {"mms_id": "2", "name": "Camera bag", "type": "BIB"})
+
+    def test_elasticsearch_is_only_used_when_nothing_is_found(self):
+        request = RequestFactory().get("/items/autocomplete", {"query": "cam"})
+        request.user = prepare(User)
+        with patch("alma.items.views.get_catalog_index", return_value=self.index):
+            with patch("alma.items.views.match_search") as match_search:
+                response = autocomplete(request)
+                self.assertFalse(match_search.called)
+                self.assertEqual(len(json.loads(response.content.decode())), 2)
+
+                request.GET = {"query": "camra"}
+                match_search.side_effect = ElasticsearchException()
+                response = autocomplete(request)
+                self.assertTrue(match_search.called)
+                self.assertEqual(json.loads(response.content.decode()), [])
+
+                # the failure isn't cached
+                match_search.side_effect = None
+                match_search.return_value = [{"mms_id": "1", "name": "Camera", "type": "BIB"}]
+                response = autocomplete(request)
+                self.assertEqual(json.loads(response.content.decode()), match_search.return_value)
+
+    def test_the_index_is_reloaded_when_the_catalog_changes(self):
+        make(Bib, mms_id="1", name="Camera")
+        with patch("alma.items.catalog._index", None), patch("alma.items.catalog._version", None):
+            self.assertEqual(get_catalog_index().bibs, {"1": "Camera"})
+            make(Bib, mms_id="2", name="Tripod")
+            # the catalog version didn't change
+            self.assertEqual(get_catalog_index().bibs, {"1": "Camera"})
+            # the very next call after a sync sees the change
+            bump_catalog_version()
+            self.assertEqual(get_catalog_index().bibs, {"1": "Camera", "2": "Tripod"})
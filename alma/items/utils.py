@@ -0,0 +1,73 @@
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import receiver
+
+from alma.utils.metrics import registry
+
+from .signals import catalog_synced
+
+# the cache key holding a number that changes every time the catalog does.
+# It's part of every autocomplete cache key, so bumping it invalidates all of
+# them at once (in every process)
+CATALOG_VERSION_KEY = "items:catalog_version"
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # add() doesn't clobber a version another process just set
+        cache.add(CATALOG_VERSION_KEY, 1, None)
+        version = cache.get(CATALOG_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # the key doesn't exist (or was evicted)
+        cache.set(CATALOG_VERSION_KEY, 2, None)
+
+
+@receiver(catalog_synced)
+def bump_catalog_version_after_sync(sender, result, **kwargs):
+    if result:
+        bump_catalog_version()
+
+
+def normalize_query(query):
+    """
+    The searches are case insensitive, and don't care about extra spaces, so
+    neither should the cache
+    """
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+def autocomplete_cache_key(query):
+    # memcached doesn't allow spaces (or long keys), so the query is hashed
+    return "items:autocomplete:{mode}:{version}:{query}".format(
+        mode=settings.AUTOCOMPLETE_MODE,
+        version=get_catalog_version(),
+        query=hashlib.sha1(normalize_query(query).encode()).hexdigest(),
+    )
+
+
+def cached_autocomplete(query, search):
+    """
+    Returns the autocomplete results for the query from the cache, or calls
+    search(query) and caches what it returns for AUTOCOMPLETE_CACHE_TIMEOUT
+    seconds
+    """
+    key = autocomplete_cache_key(query)
+    results = cache.get(key)
+    if results is not None:
+        registry.incr("autocomplete_cache:hit")
+        return results
+
+    registry.incr("autocomplete_cache:miss")
+    results = search(query)
+    cache.set(key, results, settings.AUTOCOMPLETE_CACHE_TIMEOUT)
+    return results
@@ -1,8 +1,20 @@
+import logging
+
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
+from elasticsearch.exceptions import ElasticsearchException
 from elasticsearch_dsl import Q
+from elasticsearch_dsl.connections import connections
 
+from .catalog import get_catalog_index
 from .indexes import BibIndex, ItemIndex
+from .utils import cached_autocomplete
+
+logger = logging.getLogger(__name__)
+
+# the most Items (and Bibs) to return from autocomplete
+MAX_RESULTS = 10
 
 
 @login_required
@@ -18,37 +30,139 @@ def autocomplete(request):
 
     We want to match on a Bib's name, because the user will want to type
     something in like "Firewire cable" and create a reservation for the Bib.
+
+    Barcodes, mms_ids and the beginnings of words in a Bib's name are looked
+    up in an in-process index (see alma.items.catalog). Elasticsearch is only
+    used when that finds nothing (for fuzzier matches), and both of its
+    searches are sent in one multi-search request. The results are cached
+    until the catalog changes (see alma.items.utils).
     """
     query = request.GET.get("query", "")
+    try:
+        results = cached_autocomplete(query, search)
+    except ElasticsearchException:
+        # if Elasticsearch is down, the user just doesn't get the fuzzier
+        # results. This isn't cached, so they come back with Elasticsearch
+        logger.exception("Elasticsearch autocomplete failed for %r", query)
+        results = []
+    return JsonResponse(results, safe=False)
 
-    # first, find any matches on the Item index just using the barcode field
-    dsl = Q("multi_match", analyzer="standard", query=query, fields=["barcode"])
-    dsl = ItemIndex.objects.query(dsl)
-    items = []
-    for result in dsl.execute():
-        items.append({
-            "barcode": result.barcode,
-            "name": result.name,
-            "description": result.description,
-            "category": result.category,
-            "type": "ITEM",
-        })
 
-    # second, we query for matching Bibs
-    dsl = Q("multi_match", query=query, fields=["name"])
+def search(query):
+    """
+    Returns a list of dicts for the Items and Bibs matching the query (see
+    autocomplete()). If the in-process index finds nothing, Elasticsearch is
+    searched with the "match" or "suggest" search depending on
+    settings.AUTOCOMPLETE_MODE
+    """
+    if settings.AUTOCOMPLETE_IN_MEMORY:
+        results = get_catalog_index().search(query, MAX_RESULTS)
+        if results:
+            return results
+
+    if settings.AUTOCOMPLETE_MODE == "suggest":
+        return suggest_search(query)
+    return match_search(query)
+
+
+def msearch(*searches):
+    """
+    Sends the (doc_type, body) searches to Elasticsearch in one multi-search
+    request, and returns the responses
+    """
+    index_name = settings.ELASTICSEARCH_CONNECTIONS['default']['index_name']
+    body = []
+    for doc_type, search_body in searches:
+        body.extend([{"index": index_name, "type": doc_type}, search_body])
+
+    return connections.get_connection().msearch(body=body)['responses']
+
+
+def item_result(result):
+    return {
+        "barcode": result.get('barcode'),
+        "name": result.get('name'),
+        "description": result.get('description'),
+        "category": result.get('category'),
+        "type": "ITEM",
+    }
+
+
+def bib_result(result):
+    return {
+        "mms_id": result.get('mms_id'),
+        "name": result.get('name'),
+        "type": "BIB",
+    }
+
+
+def exact_mms_id_query(query):
     # on the typeahead autocomplete textbox, in the user interface, if the user selects an item,
     # that could potentially re-order the items in the typeahead drop down
     # (because ES will re-query based on the text of the option they selected). That
     # causes some weird issues when using the TAB key in that form field. To
     # avoid that problem, we boost the item_id field, so once it is selected,
     # it will always appear first in the search results.
-    dsl |= Q("multi_match", analyzer="standard", query=query, fields=["mms_id^10"])
-    dsl = BibIndex.objects.query(dsl)
-    for result in dsl.execute():
-        items.append({
-            "mms_id": result.mms_id,
-            "name": result.name,
-            "type": "BIB",
-        })
-
-    return JsonResponse(items, safe=False)
+    return Q("multi_match", analyzer="standard", query=query, fields=["mms_id^10"])
+
+
+def match_search(query):
+    """
+    Searches the edge ngrams of the Bib names with a scored multi_match
+    """
+    # first, find any matches on the Item index just using the barcode field
+    dsl = Q("multi_match", analyzer="standard", query=query, fields=["barcode"])
+    item_search = ItemIndex.objects.query(dsl).extra(size=MAX_RESULTS, _source=["barcode", "name", "description", "category"])
+
+    # second, we query for matching Bibs
+    dsl = Q("multi_match", query=query, fields=["name"]) | exact_mms_id_query(query)
+    bib_search = BibIndex.objects.query(dsl).extra(size=MAX_RESULTS, _source=["mms_id", "name"])
+
+    item_response, bib_response = msearch(("item", item_search.to_dict()), ("bib", bib_search.to_dict()))
+
+    items = [item_result(hit['_source']) for hit in item_response['hits']['hits']]
+    items.extend(bib_result(hit['_source']) for hit in bib_response['hits']['hits'])
+    return items
+
+
+def suggest_search(query):
+    """
+    Uses the completion suggesters on the Item barcodes and Bib names for
+    prefix lookups. Exact barcode and mms_id matches are still searched for
+    (and come first), so selecting an option in the typeahead doesn't
+    re-order it
+    """
+    def suggest(field):
+        return {"suggestions": {"text": query, "completion": {"field": field, "size": MAX_RESULTS}}}
+
+    dsl = Q("multi_match", analyzer="standard", query=query, fields=["barcode"])
+    item_search = ItemIndex.objects.query(dsl).extra(size=MAX_RESULTS, _source=["barcode", "name", "description", "category"], suggest=suggest("suggest"))
+    bib_search = BibIndex.objects.query(exact_mms_id_query(query)).extra(size=MAX_RESULTS, _source=["mms_id", "name"], suggest=suggest("suggest"))
+
+    item_response, bib_response = msearch(("item", item_search.to_dict()), ("bib", bib_search.to_dict()))
+
+    def suggestions(response):
+        for suggestion in response.get('suggest', {}).get('suggestions', []):
+            for option in suggestion['options']:
+                yield option
+
+    items = []
+    barcodes = set()
+    for hit in item_response['hits']['hits']:
+        items.append(item_result(hit['_source']))
+        barcodes.add(hit['_source'].get('barcode'))
+    for option in suggestions(item_response):
+        if option['payload']['barcode'] not in barcodes:
+            items.append(item_result(option['payload']))
+            barcodes.add(option['payload']['barcode'])
+
+    mms_ids = set()
+    for hit in bib_response['hits']['hits']:
+        items.append(bib_result(hit['_source']))
+        mms_ids.add(hit['_source'].get('mms_id'))
+    for option in suggestions(bib_response):
+        if option['payload']['mms_id'] not in mms_ids:
+            items.append(bib_result({"mms_id": option['payload']['mms_id'], "name": option['text']}))
+            mms_ids.add(option['payload']['mms_id'])
+
+    return items
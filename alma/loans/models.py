@@ -1,8 +1,10 @@
+from django.conf import settings
 from django.db import models
 from django.template.loader import render_to_string
 from django.utils.timezone import now
 
 from alma.api import create_loan, return_loan
+from alma.outbox.utils import enqueue, placeholder_id
 from alma.utils import ImpotentManager
 
 
@@ -37,18 +39,29 @@ class Loan(models.Model):
     def delete(self):
         # make sure to clean up the loan in Alma before deleting
         if self.returned_on is None:
-            return_loan(mms_id=self.item.bib.pk, item_id=self.item.pk)
+            self.return_in_alma()
         return super().delete()
 
     def save(self, *args, **kwargs):
         """
         Create the loan in Alma or mark it as returned
         """
-        if self.returned_on is None:
+        if self.returned_on is None and settings.ALMA_OUTBOX:
+            # the worker creates the loan (see alma.outbox.utils)
+            self.loan_id = placeholder_id()
+            enqueue("create_loan", self.item.bib_id, self.loan_id, username=self.user.username, barcode=self.item.barcode)
+        elif self.returned_on is None:
             # the item is being checked out
             response = create_loan(username=self.user.username, barcode=self.item.barcode)
             self.loan_id = response['loan_id']
         else:
-            return_loan(mms_id=self.item.bib.pk, item_id=self.item.pk)
+            self.return_in_alma()
 
         return super().save(*args, **kwargs)
+
+    def return_in_alma(self):
+        kwargs = dict(mms_id=self.item.bib_id, item_id=self.item.pk, holding_id=self.item.holding_id)
+        if settings.ALMA_OUTBOX:
+            enqueue("return_loan", self.item.bib_id, self.pk, **kwargs)
+        else:
+            return_loan(**kwargs)
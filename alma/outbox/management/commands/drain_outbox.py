@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from alma.outbox.utils import drain
+from alma.utils import LockNotAcquired, advisory_lock
+
+
+class Command(BaseCommand):
+    help = "Makes the Alma calls that are waiting in the outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", default=False, help="Drain the outbox and exit, instead of polling it forever")
+
+    def handle(self, *args, once, **options):
+        # one worker at a time, so operations on a bib stay in order
+        try:
+            with advisory_lock("alma.outbox.drain_outbox"):
+                while True:
+                    count = drain()
+                    if count:
+                        self.stdout.write("Ran {0} operations".format(count))
+                    if once:
+                        break
+                    time.sleep(settings.ALMA_OUTBOX_POLL_INTERVAL)
+        except LockNotAcquired:
+            raise CommandError("Another worker is already running")
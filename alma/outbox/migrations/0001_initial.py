@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Operation',
+            fields=[
+                ('operation_id', models.AutoField(primary_key=True, serialize=False)),
+                ('action', models.CharField(max_length=255)),
+                ('arguments', models.TextField()),
+                ('mms_id', models.CharField(max_length=255, db_index=True)),
+                ('object_id', models.CharField(max_length=255, blank=True, db_index=True)),
+                ('status', models.CharField(max_length=16, default='pending', choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('run_after', models.DateTimeField(auto_now_add=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('finished_on', models.DateTimeField(default=None, null=True)),
+            ],
+            options={
+                'db_table': 'operation',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='operation',
+            index_together=set([('status', 'mms_id')]),
+        ),
+    ]
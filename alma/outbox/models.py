@@ -0,0 +1,53 @@
+import json
+
+from django.db import models
+
+from alma.api import default
+
+
+class Operation(models.Model):
+    """
+    A write to Alma that is waiting to be made (or was made) by the worker
+    (see alma.outbox.utils). Operations are saved in the same transaction as
+    the Requests and Loans they are for, and are run in order for each bib
+    """
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    operation_id = models.AutoField(primary_key=True)
+    # the name of the function in alma.api to call
+    action = models.CharField(max_length=255)
+    # the keyword arguments for that function, as JSON
+    arguments = models.TextField()
+    # operations on the same bib are run in the order they were created
+    mms_id = models.CharField(max_length=255, db_index=True)
+    # the pk of the Request or Loan this operation creates. Until the
+    # operation is done, the object has a placeholder pk
+    object_id = models.CharField(max_length=255, blank=True, db_index=True)
+    # the real pk that replaced the placeholder in object_id, once Alma
+    # created the object
+    resolved_id = models.CharField(max_length=255, blank=True, default="", db_index=True)
+
+    status = models.CharField(max_length=16, default=PENDING, choices=[(PENDING, "Pending"), (DONE, "Done"), (FAILED, "Failed")])
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # failed attempts are retried after this
+    run_after = models.DateTimeField(auto_now_add=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    finished_on = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        db_table = "operation"
+        index_together = [("status", "mms_id")]
+
+    def __str__(self):
+        return "{0} {1} ({2})".format(self.action, self.mms_id, self.status)
+
+    @property
+    def kwargs(self):
+        return json.loads(self.arguments)
+
+    @kwargs.setter
+    def kwargs(self, kwargs):
+        self.arguments = json.dumps(kwargs, default=default)
@@ -0,0 +1,133 @@
+import json
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.db import DatabaseError
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from model_mommy.mommy import make, prepare
+
+from alma.items.models import Bib, Item
+from alma.loans.models import Loan
+from alma.requests.models import Request, Reservation
+from alma.users.models import User
+
+from .models import Operation
+from .utils import drain, get_status, is_placeholder, next_operations
+from .views import status as status_view
+
+
+@override_settings(ALMA_OUTBOX=True, ALMA_OUTBOX_MAX_ATTEMPTS=2)
+class OutboxTest(TestCase):
+    def setUp(self):
+        self.bib = make(Bib)
+        self.start = now().replace(microsecond=0) + timedelta(days=1)
+
+    def reserve(self):
+        reservation = prepare(Reservation, bib=self.bib)
+        with patch("alma.requests.models.create_booking") as create_booking:
+            reservation.save(starting_on=self.start, ending_on=self.start + timedelta(hours=1))
+        # nothing was sent to Alma yet
+        self.assertFalse(create_booking.called)
+        return Request.objects.get(reservation=reservation)
+
+    def test_bookings_are_made_by_the_worker(self):
+        request = self.reserve()
+        self.assertTrue(is_placeholder(request.pk))
+
+        with patch("alma.api.create_booking", return_value={"request_id": "123"}) as create_booking:
+            self.assertEqual(drain(), 1)
+
+        kwargs = create_booking.call_args[1]
+        self.assertEqual(kwargs['mms_id'], self.bib.pk)
+        self.assertEqual(kwargs['start_date'], self.start)
+        self.assertEqual(list(Request.objects.values_list("pk", flat=True)), ["123"])
+        self.assertEqual(Operation.objects.get().status, Operation.DONE)
+
+    def test_status_can_be_polled_with_the_placeholder(self):
+        request = self.reserve()
+        self.assertEqual(get_status([request.pk])[request.pk]['status'], Operation.PENDING)
+
+        with patch("alma.api.create_booking", return_value={"request_id": "123"}):
+            drain()
+
+        # the client only knows the placeholder, and learns the real id
+        status = get_status([request.pk])[request.pk]
+        self.assertEqual(status['status'], Operation.DONE)
+        self.assertEqual(status['id'], "123")
+        # the real id works too
+        self.assertEqual(get_status(["123"])["123"]['status'], Operation.DONE)
+
+        http_request = RequestFactory().get("/outbox/status", {"ids": request.pk + ",unknown"})
+        http_request.user = prepare(User)
+        response = json.loads(status_view(http_request).content.decode())
+        self.assertEqual(list(response['operations']), [request.pk])
+        self.assertEqual(response['operations'][request.pk]['id'], "123")
+        self.assertEqual(response['pending'], 0)
+
+    def test_operations_on_a_bib_run_in_order(self):
+        request = self.reserve()
+        # cancel it before the booking was even made
+        Request.objects.filter(pk=request.pk).cancel()
+        other = make(Operation, action="return_loan", mms_id="other", arguments="{}")
+        self.assertEqual([operation.action for operation in next_operations()], ["create_booking", "return_loan"])
+        other.delete()
+
+        with patch("alma.api.create_booking", return_value={"request_id": "123"}), patch("alma.api.delete_booking") as delete_booking:
+            self.assertEqual(drain(), 2)
+
+        # the placeholder was swapped for the real request_id
+        delete_booking.assert_called_once_with(request_id="123", mms_id=self.bib.pk)
+        self.assertEqual(Request.objects.count(), 0)
+
+    def test_failures_are_retried_then_given_up_on(self):
+        request = self.reserve()
+        Request.objects.filter(pk=request.pk).cancel()
+
+        with patch("alma.api.create_booking", side_effect=ValueError("Alma is down")) as create_booking:
+            drain()
+            operation = Operation.objects.get(action="create_booking")
+            self.assertEqual(operation.status, Operation.PENDING)
+            self.assertEqual(operation.last_error, "Alma is down")
+            # it waits before trying again
+            self.assertGreater(operation.run_after, now())
+            self.assertEqual(drain(), 0)
+
+            Operation.objects.update(run_after=now())
+            drain()
+
+        self.assertEqual(create_booking.call_count, 2)
+        # the delete can't work if the booking was never made
+        self.assertEqual(set(Operation.objects.values_list("status", flat=True)), {Operation.FAILED})
+
+    def test_operations_that_cannot_be_saved_are_not_sent_again(self):
+        request = self.reserve()
+
+        with patch("alma.api.create_booking", return_value={"request_id": "123"}) as create_booking:
+            with patch("alma.outbox.utils.apply", side_effect=DatabaseError("the database is down")):
+                drain()
+            Operation.objects.update(run_after=now())
+            drain()
+
+        # Alma already made the booking, so it isn't made again
+        self.assertEqual(create_booking.call_count, 1)
+        operation = Operation.objects.get()
+        self.assertEqual(operation.status, Operation.FAILED)
+        self.assertEqual(operation.attempts, 1)
+        self.assertIn('"123"', operation.last_error)
+        self.assertIn("the database is down", operation.last_error)
+        self.assertEqual(list(Request.objects.values_list("pk", flat=True)), [request.pk])
+
+    def test_loans_are_made_by_the_worker(self):
+        item = make(Item, bib=self.bib)
+        request = self.reserve()
+        loan = Loan(item=item, user=request.reservation.user)
+        loan.save()
+        Request.objects.filter(pk=request.pk).update(loan=loan)
+
+        with patch("alma.api.create_booking", return_value={"request_id": "123"}), patch("alma.api.create_loan", return_value={"loan_id": "456"}):
+            self.assertEqual(drain(), 2)
+
+        self.assertEqual(Request.objects.get().loan_id, "456")
+        self.assertEqual(Loan.objects.get().pk, "456")
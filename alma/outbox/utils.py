@@ -0,0 +1,203 @@
+"""
+When settings.ALMA_OUTBOX is True, Requests and Loans don't call Alma while
+they are being saved. Instead, an Operation is saved (in the same transaction)
+and the Request or Loan gets a placeholder pk. The worker (manage.py
+drain_outbox) makes the Alma calls, and swaps the placeholder for the real
+request_id or loan_id when they succeed.
+
+Operations on the same bib are run in the order they were created (so a
+booking is never deleted before it is made). A failed operation is retried,
+with a backoff, up to ALMA_OUTBOX_MAX_ATTEMPTS times, and holds up the
+operations after it on the same bib until then. An operation Alma accepted,
+but whose result couldn't be saved, is never retried (that would do it twice
+in Alma). It fails with Alma's response in last_error instead.
+"""
+import json
+import logging
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from alma import api
+from alma.api import default, parse_alma_datetime
+from alma.utils.metrics import registry
+
+from .models import Operation
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_PREFIX = "pending-"
+
+
+def placeholder_id():
+    """Returns a pk for a Request or Loan that isn't in Alma yet"""
+    return PLACEHOLDER_PREFIX + uuid.uuid4().hex
+
+
+def is_placeholder(pk):
+    return str(pk).startswith(PLACEHOLDER_PREFIX)
+
+
+def enqueue(action, mms_id, object_id="", **kwargs):
+    """
+    Saves an Operation to call alma.api.<action>(**kwargs). `object_id` is
+    the pk of the Request or Loan it is for. This should be called in the same
+    transaction as the change to that object
+    """
+    operation = Operation(action=action, mms_id=mms_id, object_id=object_id)
+    operation.kwargs = kwargs
+    operation.save()
+    return operation
+
+
+def get_status(object_ids):
+    """
+    Returns a dict of the status of the latest Operation for each of the
+    Request or Loan pks (the ones without any operations are left out). A pk
+    can be a placeholder or the real id that replaced it. "id" is the object's
+    current pk (the real id, once Alma has created it)
+    """
+    object_ids = set(object_ids)
+    statuses = {}
+    operations = Operation.objects.filter(Q(object_id__in=object_ids) | Q(resolved_id__in=object_ids)).order_by("operation_id")
+    for operation in operations:
+        status = {
+            "id": operation.resolved_id or operation.object_id,
+            "action": operation.action,
+            "status": operation.status,
+            "attempts": operation.attempts,
+            "last_error": operation.last_error,
+        }
+        for pk in set([operation.object_id, operation.resolved_id]) & object_ids:
+            statuses[pk] = status
+    return statuses
+
+
+def next_operations():
+    """
+    Returns the oldest pending Operation for each bib, if it is due to run
+    """
+    heads = OrderedDict()
+    for operation in Operation.objects.filter(status=Operation.PENDING).order_by("operation_id"):
+        heads.setdefault(operation.mms_id, operation)
+    return [operation for operation in heads.values() if operation.run_after <= now()]
+
+
+def call(operation):
+    """Makes the Alma call for the Operation, and returns the response"""
+    kwargs = operation.kwargs
+    for name in ["start_date", "end_date"]:
+        if name in kwargs:
+            kwargs[name] = parse_alma_datetime(kwargs[name])
+    return getattr(api, operation.action)(**kwargs)
+
+
+def apply(operation, response):
+    """
+    Updates our database with the response from Alma. The placeholder pk of
+    the Request or Loan the operation created is replaced with the real one
+    (in the database, and in the arguments of the operations after it). The
+    operations keep the placeholder in object_id, and get the real id in
+    resolved_id, so the status can be looked up by either
+    """
+    from alma.loans.models import Loan
+    from alma.requests.models import Request
+
+    if operation.action == "create_booking":
+        pk = response['request_id']
+        Request.objects.filter(pk=operation.object_id).update(request_id=pk)
+    elif operation.action == "create_loan":
+        pk = response['loan_id']
+        # the foreign key constraints are deferred until the transaction
+        # commits, so the Request can be pointed at the new pk after
+        Loan.objects.filter(pk=operation.object_id).update(loan_id=pk)
+        Request.objects.filter(loan_id=operation.object_id).update(loan_id=pk)
+    else:
+        return
+
+    operation.resolved_id = pk
+    for later in Operation.objects.filter(status=Operation.PENDING, object_id=operation.object_id).exclude(pk=operation.pk):
+        later.kwargs = dict((name, pk if value == operation.object_id else value) for name, value in later.kwargs.items())
+        later.resolved_id = pk
+        later.save()
+
+
+def give_up(operation, error):
+    """
+    Marks the Operation as failed (without retrying it), along with whatever
+    comes after it for the same object, since that can't work either (you
+    can't delete a booking that was never made)
+    """
+    operation.status = Operation.FAILED
+    operation.finished_on = now()
+    operation.last_error = error
+    if operation.object_id:
+        Operation.objects.filter(status=Operation.PENDING, object_id=operation.object_id).exclude(pk=operation.pk).update(
+            status=Operation.FAILED,
+            finished_on=now(),
+            last_error="Operation {0} failed".format(operation.pk),
+        )
+    operation.save()
+
+
+def run(operation):
+    """
+    Runs the Operation, and records whether it worked. If it didn't, it is
+    retried later (or marked as failed after ALMA_OUTBOX_MAX_ATTEMPTS)
+    """
+    operation.attempts += 1
+    try:
+        with registry.timer("outbox:" + operation.action):
+            response = call(operation)
+    except Exception as e:
+        logger.exception("Operation %s failed", operation.pk)
+        if operation.attempts >= settings.ALMA_OUTBOX_MAX_ATTEMPTS:
+            give_up(operation, str(e))
+        else:
+            operation.last_error = str(e)
+            delay = settings.ALMA_OUTBOX_RETRY_DELAY * 2**(operation.attempts - 1)
+            operation.run_after = now() + timedelta(seconds=delay)
+            operation.save()
+        return False
+
+    try:
+        with transaction.atomic():
+            apply(operation, response)
+            operation.status = Operation.DONE
+            operation.finished_on = now()
+            operation.last_error = ""
+            operation.save()
+    except Exception as e:
+        # Alma already did it, so running it again would duplicate the booking
+        # or loan. Give up, and keep Alma's response so a person can fix our
+        # side of it
+        logger.exception("Operation %s was done in Alma, but couldn't be saved", operation.pk)
+        operation.resolved_id = ""
+        give_up(operation, "Alma responded with {0}, but saving it failed: {1}".format(json.dumps(response, default=default), e))
+        return False
+    return True
+
+
+def drain():
+    """
+    Runs every Operation that is ready to run (including the ones that become
+    ready as the operations ahead of them finish). Returns the number of
+    Operations that were run
+    """
+    count = 0
+    while True:
+        operations = next_operations()
+        if not operations:
+            return count
+        progress = False
+        for operation in operations:
+            progress = run(operation) or progress
+            count += 1
+        if not progress:
+            # everything that is ready failed, so wait for the retries
+            return count
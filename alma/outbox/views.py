@@ -0,0 +1,19 @@
+from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
+
+from .models import Operation
+from .utils import get_status
+
+
+@login_required
+def status(request):
+    """
+    Returns the status of the Alma calls for the Requests and Loans in the
+    comma separated `ids` parameter, and how many calls are waiting, so the UI
+    can poll it
+    """
+    ids = [pk for pk in request.GET.get("ids", "").split(",") if pk]
+    return JsonResponse({
+        "operations": get_status(ids),
+        "pending": Operation.objects.filter(status=Operation.PENDING).count(),
+    })
@@ -1,6 +1,8 @@
 import re
 
 from django import forms
+from django.conf import settings
+from django.db import IntegrityError, transaction
 
 from alma.items.models import Bib, Item
 from alma.loans.models import Loan
@@ -8,7 +10,7 @@ from alma.users.models import User
 from alma.users.utils import is_ldap_user
 
 from .enums import DayOfWeek
-from .models import Request, Reservation
+from .models import CancellationFailed, Request, Reservation
 
 
 class OmniForm(forms.Form):
@@ -132,18 +134,45 @@ class OmniForm(forms.Form):
             loan = Loan(item=self.cleaned_data['bibs_or_item'], user=self.cleaned_data['user'])
             loan.save()
         elif action == "reserving":
-            for bib in self.cleaned_data['bibs_or_item']:
-                reservation = Reservation(
-                    created_by=created_by,
-                    repeat_on=self.cleaned_data['repeat_on'],
-                    user=self.cleaned_data['user'],
-                    bib=bib,
-                )
-                reservation.save(
-                    starting_on=self.cleaned_data['starting_on'],
-                    ending_on=self.cleaned_data["ending_on"],
-                    end_repeating_on=self.cleaned_data.get("end_repeating_on")
-                )
+            # the bookings made in Alma for each bib's Reservation, in case a
+            # later bib fails
+            bookings = []
+            try:
+                # a savepoint, so an IntegrityError can be shown on the form
+                # without breaking the request's transaction
+                with transaction.atomic():
+                    for bib in self.cleaned_data['bibs_or_item']:
+                        reservation = Reservation(
+                            created_by=created_by,
+                            repeat_on=self.cleaned_data['repeat_on'],
+                            user=self.cleaned_data['user'],
+                            bib=bib,
+                        )
+                        reservation.save(
+                            starting_on=self.cleaned_data['starting_on'],
+                            ending_on=self.cleaned_data["ending_on"],
+                            end_repeating_on=self.cleaned_data.get("end_repeating_on")
+                        )
+                        bookings.append((reservation, list(Request.objects.filter(reservation=reservation).values_list("request_id", flat=True))))
+            except IntegrityError:
+                # Postgres refused a Request that overlaps another one for the
+                # same bib (see the request_bib_period_excl constraint)
+                self._delete_bookings(bookings)
+                self.add_error(None, "This overlaps an existing reservation for this bib")
+            except:  # noqa
+                self._delete_bookings(bookings)
+                raise
+
+    def _delete_bookings(self, bookings):
+        """
+        The failed bib's bookings were already deleted (see
+        Reservation.create_requests), but the savepoint rolls back the
+        Reservations for the other bibs too, so their bookings have to go. With
+        the outbox, nothing was sent to Alma yet
+        """
+        if not settings.ALMA_OUTBOX:
+            for reservation, request_ids in bookings:
+                reservation.delete_bookings(request_ids)
 
 
 class RequestDeleteForm(forms.Form):
@@ -168,12 +197,22 @@ class RequestDeleteForm(forms.Form):
             ]
 
     def save(self):
-        if self.cleaned_data.get("delete"):
-            delete_choice = self.cleaned_data.get("choice")
-            if delete_choice == self.THIS:
-                self.request.delete()
-            elif delete_choice == self.THIS_AND_ALL_AFTER:
-                for r in Request.objects.filter(reservation_id=self.request.reservation_id, start__gte=self.request.start):
-                    r.delete()
-            elif delete_choice == self.THE_ENTIRE_SERIES:
+        """
+        Cancels the chosen Requests, and returns a list of (request, exception)
+        tuples for the ones that couldn't be cancelled in Alma (see
+        RequestQuerySet.cancel)
+        """
+        if not self.cleaned_data.get("delete"):
+            return []
+
+        delete_choice = self.cleaned_data.get("choice")
+        if delete_choice == self.THIS:
+            return Request.objects.filter(pk=self.request.pk).cancel()
+        elif delete_choice == self.THIS_AND_ALL_AFTER:
+            return Request.objects.filter(reservation_id=self.request.reservation_id, start__gte=self.request.start).cancel()
+        elif delete_choice == self.THE_ENTIRE_SERIES:
+            try:
                 Reservation.objects.get(reservation_id=self.request.reservation_id).delete()
+            except CancellationFailed as e:
+                return e.failures
+        return []
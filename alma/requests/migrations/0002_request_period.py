@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.ranges
+from django.contrib.postgres.operations import CreateExtension
+from django.db import models, migrations
+
+
+def check_server_version(apps, schema_editor):
+    # range types (tstzrange) were added in Postgres 9.2, and the Makefile
+    # still lists 9.1. Fail with a clear message instead of halfway through
+    if schema_editor.connection.pg_version < 90200:
+        raise RuntimeError("This migration needs Postgres 9.2 or later (for tstzrange). Upgrade the database server first.")
+
+
+def check_overlaps(apps, schema_editor):
+    # a bib can have several items, so Alma has always accepted overlapping
+    # bookings for it. The exclusion constraint can't be added while any
+    # exist, so list them, and leave it to a person to decide which to cancel
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT a.bib_id, a.request_id, a.start, a."end", b.request_id, b.start, b."end"
+            FROM request a
+            INNER JOIN request b ON a.bib_id = b.bib_id AND a.request_id < b.request_id AND a.period && b.period
+            ORDER BY a.bib_id, a.start
+        """)
+        overlaps = cursor.fetchall()
+
+    if overlaps:
+        raise RuntimeError("These requests overlap, and have to be cancelled or moved before this migration can run:\n" + "\n".join(
+            "bib %s: request %s (%s to %s) overlaps request %s (%s to %s)" % row for row in overlaps
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0003_item_holding_id'),
+        ('requests', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_server_version, migrations.RunPython.noop),
+        # lets the exclusion constraint use = on bib_id in a GiST index
+        CreateExtension('btree_gist'),
+        migrations.AddField(
+            model_name='request',
+            name='period',
+            field=django.contrib.postgres.fields.ranges.DateTimeRangeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='request',
+            name='bib',
+            field=models.ForeignKey(related_name='+', editable=False, to='items.Bib', null=True, db_index=False),
+        ),
+        migrations.RunSQL(
+            [
+                """
+                CREATE FUNCTION request_sync_period() RETURNS trigger AS $$
+                BEGIN
+                    NEW.period := tstzrange(NEW.start, NEW."end", '[)');
+                    SELECT bib_id INTO NEW.bib_id FROM reservation WHERE reservation_id = NEW.reservation_id;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql
+                """,
+                "CREATE TRIGGER request_sync_period BEFORE INSERT OR UPDATE ON request FOR EACH ROW EXECUTE PROCEDURE request_sync_period()",
+                # fill in the existing rows (the trigger does the work)
+                "UPDATE request SET period = NULL",
+                "CREATE INDEX request_period ON request USING gist (period)",
+            ],
+            [
+                "DROP INDEX request_period",
+                "DROP TRIGGER request_sync_period ON request",
+                "DROP FUNCTION request_sync_period()",
+            ],
+        ),
+        migrations.RunPython(check_overlaps, migrations.RunPython.noop),
+        migrations.RunSQL(
+            "ALTER TABLE request ADD CONSTRAINT request_bib_period_excl EXCLUDE USING gist (bib_id WITH =, period WITH &&)",
+            "ALTER TABLE request DROP CONSTRAINT request_bib_period_excl",
+        ),
+    ]
@@ -12,19 +12,29 @@ A Request object represents a request for a Bib on a particular datetime. There
 may be one or more of these attached to a Reservation object. Request objects
 have a representation in Alma (whereas a Reservation does not).
 """
+import itertools
+import logging
 from collections import namedtuple
 from datetime import timedelta
 
+from django.conf import settings
+from django.contrib.postgres.fields import DateTimeRangeField
 from django.db import models
 from django.template.loader import render_to_string
+from psycopg2.extras import DateTimeTZRange
 
-from alma.api import create_booking, delete_booking
+from alma.api import concurrent_map, create_booking, delete_booking
+from alma.outbox.utils import enqueue, placeholder_id
 from alma.utils import ImpotentManager
 
 from .enums import DayOfWeek
 
+logger = logging.getLogger(__name__)
 
-def iter_intervals(starting_on, ending_on, end_repeating_on=None, repeat_on=0):
+Interval = namedtuple("Interval", "start end")
+
+
+def iter_intervals(starting_on, ending_on, end_repeating_on=None, repeat_on=0, count=None, exclude=()):
     """
     Yields named two-tuples containing datetimes representing an interval that
     starts on `starting_on` and ends on `ending_on`, and can optionally repeat
@@ -33,17 +43,41 @@ def iter_intervals(starting_on, ending_on, end_repeating_on=None, repeat_on=0):
     The elements in the tuple are named "start" and "end".
 
     repeat_on can be an ORing of DayOfWeek enums
-    """
-    start = starting_on
-    end = end_repeating_on or ending_on
-    duration = ending_on - start
-    Interval = namedtuple("Interval", "start end")
 
-    date = start
-    while date <= end:
-        if date == start or ((2**((date.weekday()+1) % 7)) & repeat_on):
-            yield Interval(date, date+duration)
-        date += timedelta(days=1)
+    `count` is the most intervals to yield. If it is given without an
+    end_repeating_on, the intervals repeat until there are `count` of them.
+    Intervals starting on a date in `exclude` are skipped (and don't count
+    towards `count`).
+    """
+    duration = ending_on - starting_on
+    if end_repeating_on is None and count is not None:
+        last_day = None
+    else:
+        # the number of whole days after starting_on the last interval can start
+        last_day = ((end_repeating_on or ending_on) - starting_on) // timedelta(days=1)
+
+    # the days after starting_on (up to a week) that are on one of the
+    # repeat_on days. Every week after that is the same, just 7 days later
+    weekday = starting_on.weekday()
+    offsets = [day for day in range(1, 8) if (2**((weekday + day + 1) % 7)) & repeat_on]
+
+    def iter_days():
+        yield 0
+        if offsets:
+            for week in itertools.count():
+                for day in offsets:
+                    yield week*7 + day
+
+    exclude = set(exclude)
+    yielded = 0
+    for day in iter_days():
+        if (last_day is not None and day > last_day) or (count is not None and yielded >= count):
+            break
+        start = starting_on + timedelta(days=day)
+        if start.date() in exclude:
+            continue
+        yield Interval(start, start+duration)
+        yielded += 1
 
 
 class Reservation(models.Model):
@@ -83,21 +117,133 @@ class Reservation(models.Model):
         Saves the reservation, and all the related Requests
         """
         to_return = super().save(*args, **kwargs)
-        for interval in iter_intervals(starting_on, ending_on, end_repeating_on, self.repeat_on):
-            Request(start=interval[0], end=interval[1], reservation=self).save()
-
+        self.create_requests(iter_intervals(starting_on, ending_on, end_repeating_on, self.repeat_on))
         return to_return
 
+    def create_requests(self, intervals):
+        """
+        Creates a booking in Alma for each (start, end) interval, and saves the
+        Requests for them with one INSERT. The bookings are made concurrently
+        (see alma.api.concurrent_map).
+
+        If any booking fails (or the Requests can't be saved), the bookings
+        that were made are deleted from Alma, and the exception is re-raised,
+        so there are never bookings in Alma we don't know about
+        """
+        # don't lazy load these in every thread
+        username = self.user.username
+        mms_id = self.bib_id
+
+        if settings.ALMA_OUTBOX:
+            # the worker makes the bookings (see alma.outbox.utils)
+            requests = [Request(request_id=placeholder_id(), start=interval[0], end=interval[1], reservation=self) for interval in intervals]
+            Request.objects.bulk_create(requests)
+            for request in requests:
+                enqueue("create_booking", mms_id, request.pk, username=username, mms_id=mms_id, start_date=request.start, end_date=request.end)
+            return requests
+
+        def book(interval):
+            try:
+                response = create_booking(username=username, mms_id=mms_id, start_date=interval[0], end_date=interval[1])
+                return response['request_id'], None
+            except Exception as e:
+                return None, e
+
+        intervals = list(intervals)
+        results = concurrent_map(book, intervals)
+        request_ids = [request_id for request_id, error in results if request_id is not None]
+        errors = [error for request_id, error in results if error is not None]
+        try:
+            if errors:
+                raise errors[0]
+            requests = [
+                Request(request_id=request_id, start=interval[0], end=interval[1], reservation=self)
+                for (request_id, error), interval in zip(results, intervals)
+            ]
+            Request.objects.bulk_create(requests)
+        except:  # noqa
+            self.delete_bookings(request_ids)
+            raise
+
+        return requests
+
+    def delete_bookings(self, request_ids):
+        """
+        Deletes the bookings from Alma (concurrently). This is only used to
+        undo bookings that don't have a Request, so failures are logged
+        instead of raised
+        """
+        def delete(request_id):
+            try:
+                delete_booking(request_id, self.bib_id)
+            except Exception:
+                logger.exception("Couldn't delete booking %s for bib %s. It is orphaned in Alma", request_id, self.bib_id)
+
+        concurrent_map(delete, request_ids)
+
     def delete(self, *args, **kwargs):
         """
-        Deletes all the related Requests and then this reservation itself
+        Cancels all the related Requests and then deletes this reservation
+        itself. If some of the Requests couldn't be cancelled in Alma,
+        CancellationFailed is raised, and the reservation is kept (deleting it
+        would delete those Requests too)
         """
-        requests = Request.objects.filter(reservation=self)
-        for request in requests:
-            request.delete()
+        failures = Request.objects.filter(reservation=self).cancel()
+        if failures:
+            raise CancellationFailed(failures)
         super().delete(*args, **kwargs)
 
 
+class CancellationFailed(Exception):
+    """
+    Raised when some Requests couldn't be cancelled in Alma. `failures` is a
+    list of (request, exception) tuples
+    """
+    def __init__(self, failures):
+        super().__init__(failures)
+        self.failures = failures
+
+
+class RequestQuerySet(models.QuerySet):
+    def overlapping(self, bib, start, end):
+        """
+        Returns the Requests for the bib that overlap the interval from start
+        to end (which is one lookup on the exclusion constraint's index)
+        """
+        return self.filter(bib=bib, period__overlap=DateTimeTZRange(start, end))
+
+    def cancel(self):
+        """
+        Deletes the bookings for these Requests in Alma (concurrently, see
+        alma.api.concurrent_map), and then deletes the Requests whose booking
+        was deleted with one query.
+
+        The Requests that couldn't be deleted in Alma are kept, so our database
+        still matches Alma. They are returned as a list of (request,
+        exception) tuples
+        """
+        requests = list(self.select_related("reservation"))
+        if settings.ALMA_OUTBOX:
+            # the worker deletes the bookings (see alma.outbox.utils)
+            for request in requests:
+                enqueue("delete_booking", request.reservation.bib_id, request.pk, request_id=request.pk, mms_id=request.reservation.bib_id)
+            self.filter(pk__in=[request.pk for request in requests]).delete()
+            return []
+
+        def cancel(request):
+            try:
+                delete_booking(request.request_id, request.reservation.bib_id)
+            except Exception as e:
+                logger.exception("Couldn't delete booking %s in Alma", request.request_id)
+                return e
+
+        errors = concurrent_map(cancel, requests)
+        cancelled = [request.pk for request, error in zip(requests, errors) if error is None]
+        if cancelled:
+            Request.objects.filter(pk__in=cancelled).delete()
+        return [(request, error) for request, error in zip(requests, errors) if error is not None]
+
+
 class Request(models.Model):
     """
     Represents a Request in Alma. This object must have a parent Reservation
@@ -112,7 +258,16 @@ class Request(models.Model):
     reservation = models.ForeignKey(Reservation, help_text="The parent reservation linking one or more requests together")
     loan = models.OneToOneField("loans.Loan", null=True, default=None)
 
-    objects = ImpotentManager()
+    # these are filled in by a trigger whenever a row is saved (so they are
+    # right no matter how the row was saved, but are stale on the instance
+    # until it is reloaded). period is [start, end), and bib is the
+    # reservation's bib. Together they back an exclusion constraint, so the
+    # database refuses overlapping Requests for the same bib (see migration
+    # 0002_request_period)
+    period = DateTimeRangeField(null=True, editable=False)
+    bib = models.ForeignKey("items.Bib", null=True, editable=False, db_index=False, related_name="+")
+
+    objects = ImpotentManager.from_queryset(RequestQuerySet)()
 
     class Meta:
         db_table = "request"
@@ -141,7 +296,12 @@ class Request(models.Model):
         Saves the request and creates it, if necessary in Alma. **The request
         is never updated in Alma.**
         """
-        if not self.request_id:
+        if not self.request_id and settings.ALMA_OUTBOX:
+            # the worker creates the booking (see alma.outbox.utils)
+            self.pk = placeholder_id()
+            mms_id = self.reservation.bib_id
+            enqueue("create_booking", mms_id, self.pk, username=self.reservation.user.username, mms_id=mms_id, start_date=self.start, end_date=self.end)
+        elif not self.request_id:
             response = create_booking(username=self.reservation.user.username, mms_id=self.reservation.bib.mms_id, start_date=self.start, end_date=self.end)
             self.pk = response['request_id']
         return super().save(*args, **kwargs)
@@ -150,7 +310,10 @@ class Request(models.Model):
         """
         Deletes this request in Alma and in our database
         """
-        delete_booking(self.request_id, self.reservation.bib.mms_id)
+        if settings.ALMA_OUTBOX:
+            enqueue("delete_booking", self.reservation.bib_id, self.pk, request_id=self.pk, mms_id=self.reservation.bib_id)
+        else:
+            delete_booking(self.request_id, self.reservation.bib.mms_id)
         super().delete(*args, **kwargs)
 
     def to_html(self):
@@ -1,8 +1,9 @@
 from datetime import datetime, timedelta
 from unittest.mock import patch
 
+from django.db import IntegrityError, transaction
 from django.forms import ValidationError
-from django.test import TestCase
+from django.test import RequestFactory, TestCase
 from django.utils.timezone import now
 from model_mommy.mommy import make, prepare
 
@@ -14,6 +15,7 @@ from alma.utils.tests import AlmaTest
 from .enums import DayOfWeek
 from .forms import OmniForm, RequestDeleteForm
 from .models import Request, Reservation, iter_intervals
+from .views import user
 
 
 class DayOfWeekTest(TestCase):
@@ -60,6 +62,32 @@ class IterIntervalsTest(TestCase):
         intervals = list(iter_intervals(start, end, end_repeating_on, repeat_on=DayOfWeek.MONDAY | DayOfWeek.WEDNESDAY))
         self.assertEqual(len(intervals), 3)
 
+    def test_count_and_exclude(self):
+        # Jan 4 2015 is a Sunday
+        start = now().replace(year=2015, month=1, day=4)
+        end = start+timedelta(hours=1)
+        repeat_on = DayOfWeek.TUESDAY | DayOfWeek.THURSDAY
+
+        # with no end_repeating_on, count says when to stop
+        intervals = list(iter_intervals(start, end, repeat_on=repeat_on, count=4))
+        self.assertEqual([interval.start for interval in intervals], [start + timedelta(days=days) for days in [0, 2, 4, 9]])
+
+        # the end_repeating_on still applies
+        intervals = list(iter_intervals(start, end, start+timedelta(days=3), repeat_on=repeat_on, count=4))
+        self.assertEqual(len(intervals), 2)
+
+        # excluded dates are skipped, and don't count
+        exclude = [(start+timedelta(days=2)).date()]
+        intervals = list(iter_intervals(start, end, repeat_on=repeat_on, count=3, exclude=exclude))
+        self.assertEqual([interval.start for interval in intervals], [start + timedelta(days=days) for days in [0, 4, 9]])
+        self.assertEqual(intervals[-1].end, start+timedelta(days=9, hours=1))
+
+    def test_lazy(self):
+        start = now()
+        # this would never end if the intervals weren't generated lazily
+        intervals = iter_intervals(start, start+timedelta(hours=1), repeat_on=DayOfWeek.MONDAY, count=float("inf"))
+        self.assertEqual(len([next(intervals) for i in range(100)]), 100)
+
 
 class RequestTest(AlmaTest):
     def test_cache_key(self):
@@ -111,11 +139,79 @@ class RequestTest(AlmaTest):
     def test_to_html(self):
         res = prepare(Reservation, repeat_on=DayOfWeek.MONDAY | DayOfWeek.TUESDAY)
         res.save(starting_on=now(), ending_on=now()+timedelta(hours=1))
-        r = make(Request, reservation=res)
+        r = make(Request, reservation=res, start=now()-timedelta(days=1), end=now()-timedelta(hours=23))
         html = r.to_html()
         self.assertIn("Mon, Tue", html)
 
 
+class ReservationTest(AlmaTest):
+    def test_requests_are_created_in_bulk(self):
+        res = prepare(Reservation, repeat_on=DayOfWeek.MONDAY | DayOfWeek.TUESDAY)
+        # Jan 4 2015 is a Sunday, so this books Sun, Mon, Tue, Mon, Tue
+        start = now().replace(year=2015, month=1, day=4)
+        res.save(starting_on=start, ending_on=start+timedelta(hours=1), end_repeating_on=start+timedelta(days=9))
+        requests = list(Request.objects.filter(reservation=res).order_by("start"))
+        self.assertEqual([r.start for r in requests], [start + timedelta(days=days) for days in [0, 1, 2, 8, 9]])
+        self.assertEqual(len(set(r.pk for r in requests)), 5)
+
+    def test_bookings_are_deleted_when_one_fails(self):
+        res = prepare(Reservation, repeat_on=DayOfWeek.MONDAY | DayOfWeek.TUESDAY)
+        response = iter([{"request_id": "1"}, {"request_id": "2"}, {"request_id": "3"}])
+
+        def create_booking(start_date, **kwargs):
+            if start_date.weekday() == 1:
+                raise ValueError("Alma says no")
+            return next(response)
+
+        with patch("alma.requests.models.create_booking", side_effect=create_booking) as create, patch("alma.requests.models.delete_booking") as delete:
+            with self.assertRaises(ValueError):
+                # Jan 4 2015 is a Sunday, so this books Sun, Mon, Tue, Mon
+                start = now().replace(year=2015, month=1, day=4)
+                res.save(starting_on=start, ending_on=start+timedelta(hours=1), end_repeating_on=start+timedelta(days=8))
+
+        self.assertEqual(create.call_count, 4)
+        # every booking that was made is deleted
+        self.assertEqual(sorted(call[0][0] for call in delete.call_args_list), ["1", "2", "3"])
+        self.assertEqual(Request.objects.count(), 0)
+
+
+class RequestPeriodTest(AlmaTest):
+    def test_overlapping(self):
+        start = now()
+        res = prepare(Reservation)
+        res.save(starting_on=start, ending_on=start+timedelta(hours=1))
+        request = Request.objects.get(reservation=res)
+        # the trigger filled these in
+        self.assertEqual(request.bib_id, res.bib_id)
+        self.assertEqual((request.period.lower, request.period.upper), (request.start, request.end))
+
+        self.assertEqual(list(Request.objects.overlapping(res.bib, start+timedelta(minutes=30), start+timedelta(hours=2))), [request])
+        # the end isn't part of the period
+        self.assertEqual(list(Request.objects.overlapping(res.bib, start+timedelta(hours=1), start+timedelta(hours=2))), [])
+        self.assertEqual(list(Request.objects.overlapping(make(Item).bib, start, start+timedelta(hours=1))), [])
+
+    def test_overlapping_requests_for_a_bib_are_refused(self):
+        start = now()
+        res = prepare(Reservation)
+        res.save(starting_on=start, ending_on=start+timedelta(hours=1))
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                make(Request, reservation=res, start=start+timedelta(minutes=30), end=start+timedelta(hours=2))
+
+        # back to back is fine
+        make(Request, reservation=res, start=start+timedelta(hours=1), end=start+timedelta(hours=2))
+
+    def test_user_view_shows_requests_that_have_not_ended(self):
+        res = prepare(Reservation, user=make(User, email="mdj2@pdx.edu"))
+        res.save(starting_on=now()-timedelta(hours=1), ending_on=now()+timedelta(hours=1))
+        make(Request, reservation=res, start=now()-timedelta(days=1), end=now()-timedelta(hours=23))
+        request = RequestFactory().get("/requests/user", {"username": "mdj2"})
+        request.user = prepare(User)
+        with patch("alma.requests.views.render") as render:
+            user(request)
+        self.assertEqual(list(render.call_args[0][2]['requests']), [Request.objects.get(reservation=res, end__gt=now())])
+
+
 class OmniFormTest(AlmaTest):
     def test_clean_user(self):
         """
@@ -222,6 +318,53 @@ class OmniFormTest(AlmaTest):
         # 9 Request objects should be tied to this reservation
         self.assertEqual(Request.objects.filter(reservation=reservation).count(), 9)
 
+    def test_bookings_for_every_bib_are_deleted_when_one_fails(self):
+        bib1, bib2 = make(Item).bib, make(Item).bib
+        start = now().replace(year=2015, month=1, day=5)
+        form = OmniForm()
+        form.cleaned_data = {
+            "bibs_or_item": [bib1, bib2],
+            "user": make(User),
+            "repeat_on": 0,
+            "starting_on": start,
+            "ending_on": start + timedelta(hours=1),
+        }
+
+        def create_booking(mms_id, **kwargs):
+            if mms_id == bib2.pk:
+                raise ValueError("Alma says no")
+            return {"request_id": "1"}
+
+        with patch("alma.requests.models.create_booking", side_effect=create_booking), patch("alma.requests.models.delete_booking") as delete:
+            with self.assertRaises(ValueError):
+                form.save(created_by=make(User))
+
+        # the booking for the first bib is deleted too, since its Reservation
+        # gets rolled back with the request
+        self.assertEqual([call[0] for call in delete.call_args_list], [("1", bib1.pk)])
+
+    def test_overlapping_reservations_are_a_form_error(self):
+        bib1, bib2 = make(Item).bib, make(Item).bib
+        start = now().replace(year=2015, month=1, day=5)
+        existing = prepare(Reservation, bib=bib2)
+        existing.save(starting_on=start, ending_on=start+timedelta(hours=1))
+        form = OmniForm()
+        form.cleaned_data = {
+            "bibs_or_item": [bib1, bib2],
+            "user": make(User),
+            "repeat_on": 0,
+            "starting_on": start + timedelta(minutes=30),
+            "ending_on": start + timedelta(hours=2),
+        }
+
+        with patch("alma.requests.models.delete_booking") as delete:
+            form.save(created_by=make(User))
+
+        self.assertEqual(form.non_field_errors(), ["This overlaps an existing reservation for this bib"])
+        # nothing new is kept, here or in Alma
+        self.assertEqual(list(Reservation.objects.all()), [existing])
+        self.assertEqual(sorted(call[0][1] for call in delete.call_args_list), sorted([bib1.pk, bib2.pk]))
+
     def test_loan_is_created_on_save(self):
         item = make(Item)
         cleaned_data = {
@@ -263,7 +406,7 @@ class RequestDeleteFormTest(AlmaTest):
     def test_extra_choices_for_repeating_reservations_become_choices(self):
         res = prepare(Reservation, repeat_on=0)
         res.save(starting_on=now(), ending_on=now()+timedelta(hours=1))
-        r = make(Request, reservation=res)
+        r = make(Request, reservation=res, start=now()-timedelta(days=1), end=now()-timedelta(hours=23))
         form = RequestDeleteForm(request=r)
         self.assertNotIn("This and all after it", str(form['choice']))
         self.assertNotIn("The entire series", str(form['choice']))
@@ -271,7 +414,7 @@ class RequestDeleteFormTest(AlmaTest):
         # now make the reservation repeat, and now we should see the extra choices
         res = prepare(Reservation, repeat_on=DayOfWeek.MONDAY | DayOfWeek.TUESDAY)
         res.save(starting_on=now(), ending_on=now()+timedelta(hours=1))
-        r = make(Request, reservation=res)
+        r = make(Request, reservation=res, start=now()-timedelta(days=1), end=now()-timedelta(hours=23))
         form = RequestDeleteForm(request=r)
         self.assertIn("This and all after it", str(form['choice']))
         self.assertIn("The entire series", str(form['choice']))
@@ -308,3 +451,24 @@ class RequestDeleteFormTest(AlmaTest):
         self.assertTrue(form.is_valid())
         form.save()
         self.assertEqual(1, Request.objects.count())
+
+    def test_failed_cancellations_are_kept_and_reported(self):
+        res = prepare(Reservation, repeat_on=DayOfWeek.MONDAY | DayOfWeek.TUESDAY)
+        res.save(starting_on=now(), ending_on=now()+timedelta(hours=1), end_repeating_on=now()+timedelta(days=14))
+        requests = list(Request.objects.filter(reservation=res).order_by("start"))
+        stuck = requests[-1]
+
+        def delete_booking(request_id, mms_id):
+            if request_id == stuck.pk:
+                raise ValueError("Alma says no")
+
+        form = RequestDeleteForm({"delete": 1, "choice": RequestDeleteForm.THE_ENTIRE_SERIES}, request=requests[0])
+        self.assertTrue(form.is_valid())
+        with patch("alma.requests.models.delete_booking", side_effect=delete_booking) as delete:
+            failures = form.save()
+
+        self.assertEqual(delete.call_count, len(requests))
+        self.assertEqual([request.pk for request, error in failures], [stuck.pk])
+        # the request that is still in Alma is still in our database too
+        self.assertEqual(list(Request.objects.values_list("pk", flat=True)), [stuck.pk])
+        self.assertTrue(Reservation.objects.filter(pk=res.pk).exists())
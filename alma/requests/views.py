@@ -2,12 +2,13 @@ from collections import OrderedDict
 from datetime import timedelta
 
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.timezone import localtime, now
 from django.views.decorators.csrf import csrf_exempt
+from psycopg2.extras import DateTimeTZRange
 
-from alma.api import is_available
+from alma.api import concurrent_map, is_available
 from alma.loans.models import Loan
 from alma.users.models import User
 
@@ -28,7 +29,9 @@ def main(request):
         form = OmniForm(request.POST)
         if form.is_valid():
             form.save(created_by=request.user)
-            return redirect("home")
+            # saving adds an error if the reservation overlaps another one
+            if not form.errors:
+                return redirect("home")
     else:
         form = OmniForm()
 
@@ -43,7 +46,10 @@ def delete(request, request_id):
     req = get_object_or_404(Request, pk=request_id)
     form = RequestDeleteForm(request.POST, request=req)
     if form.is_valid():
-        form.save()
+        failures = form.save()
+        if failures:
+            # the Requests that couldn't be cancelled in Alma are still around
+            return JsonResponse({"failed": [r.pk for r, error in failures]}, status=502)
     return HttpResponse()
 
 
@@ -54,9 +60,10 @@ def user(request):
     """
     # TODO show loans too?
     email = User.username_to_email(request.GET.get("username", ""))
+    # the Requests that haven't ended yet (the period lookup lets Postgres use
+    # the GiST index on it)
     requests = Request.objects.filter(reservation__user__email=email).filter(
-        end__lte=now()+timedelta(hours=10000),  # TODO change this to something reasonable according to the client
-        end__gte=now()
+        period__overlap=DateTimeTZRange(now(), now()+timedelta(hours=10000)),  # TODO change this to something reasonable according to the client
     ).select_related(
         "reservation",
         "reservation__bib",
@@ -112,8 +119,10 @@ def available(request):
                 "items": []
             })
 
-        for bib in form.cleaned_data['bibs_or_item']:
-            results = list(is_available(bib.mms_id, intervals))
+        # check all the bibs at once, rather than one Alma call after another
+        bibs = form.cleaned_data['bibs_or_item']
+        all_results = concurrent_map(lambda bib: list(is_available(bib.mms_id, intervals)), bibs)
+        for bib, results in zip(bibs, all_results):
             for block, is_avail in zip(request_blocks, results):
                 block['items'].append({"name": str(bib), "is_available": is_avail})
 
@@ -157,7 +166,9 @@ def calendar(request):
     end_date = day
 
     # find all the Requests in this date range, and convert them into CalendarItem objects
+    # (the period lookup lets Postgres use the GiST index on it)
     calendar_items = [CalendarItem.from_request(req) for req in Request.objects.filter(
+        period__contained_by=DateTimeTZRange(start_date, end_date),
         end__lt=end_date,
         start__gte=start_date
     ).select_related(
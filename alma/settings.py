@@ -22,6 +22,53 @@ BASE_DIR = lambda *path: DJANGO_DIR("../", *path)
 #
 ALMA_API_KEY = variable("ALMA_API_KEY")
 
+#
+# Alma API
+#
+
+# requests to Alma go through a pooled, keep-alive HTTP session (one per
+# process). The pool size is the number of connections to Alma each process
+# will keep open
+ALMA_API_POOL_SIZE = 10
+# the maximum number of Alma calls a process will make at the same time when
+# it fans them out (see alma.api.concurrent_map). Keep this <= the pool size
+ALMA_API_MAX_CONCURRENCY = 8
+# (connect, read) timeouts in seconds
+ALMA_API_TIMEOUT = (5, 60)
+# how many times to retry a request when the connection to Alma couldn't be
+# established
+ALMA_API_MAX_RETRIES = 2
+# how long (in seconds) to cache a bib's availability. Our own bookings and
+# loans invalidate the cache, so this only bounds how stale changes made
+# outside of this application (or by another process) can be
+ALMA_AVAILABILITY_TTL = 60
+# the minimum number of days of availability to fetch from Alma, so the cached
+# response can be used for most of the availability checks that come after it
+ALMA_AVAILABILITY_MIN_DAYS = 180
+# analytics reports (used to sync the items) are polled with an exponential
+# backoff, starting at ALMA_REPORT_INITIAL_DELAY seconds, and never waiting
+# more than ALMA_REPORT_MAX_DELAY seconds between polls. We give up on the
+# report after ALMA_REPORT_TIMEOUT seconds
+ALMA_REPORT_INITIAL_DELAY = 1
+ALMA_REPORT_MAX_DELAY = 60
+ALMA_REPORT_TIMEOUT = 60*30
+# the number of rows from the analytics report to process (and commit) at a
+# time when syncing the Bibs and Items
+ALMA_SYNC_BATCH_SIZE = 1000
+# every Alma call is timed and counted (see alma.utils.metrics). Set this to
+# True to also log the request and response bodies at the DEBUG level
+ALMA_API_LOG_BODIES = variable("ALMA_API_LOG_BODIES", default=False)
+# when True, bookings, loans and returns are saved in the outbox (see
+# alma.outbox.utils) and made in Alma by a worker (manage.py drain_outbox),
+# instead of during the HTTP request
+ALMA_OUTBOX = variable("ALMA_OUTBOX", default=False)
+# a failed outbox operation is retried after ALMA_OUTBOX_RETRY_DELAY seconds
+# (doubling every time) until it has been tried ALMA_OUTBOX_MAX_ATTEMPTS times
+ALMA_OUTBOX_MAX_ATTEMPTS = 5
+ALMA_OUTBOX_RETRY_DELAY = 10
+# how long (in seconds) the worker waits between checks of the outbox
+ALMA_OUTBOX_POLL_INTERVAL = 2
+
 #
 # System and Debugging
 #
@@ -83,6 +130,20 @@ LDAP = {
         'search_dn': 'dc=pdx,dc=edu'
     }
 }
+# LDAP searches (for the users autocomplete, and to check that a username
+# exists) are cached. Searches that found something are cached for
+# LDAP_CACHE_TIMEOUT seconds, and searches that didn't for
+# LDAP_NEGATIVE_CACHE_TIMEOUT seconds
+LDAP_CACHE_TIMEOUT = 60*60
+LDAP_NEGATIVE_CACHE_TIMEOUT = 60*5
+# group membership (which is checked on every login) changes more often than
+# names do, so it is cached for less time
+LDAP_GROUP_CACHE_TIMEOUT = 60*5
+# the users autocomplete searches a local copy of the people in LDAP matching
+# this filter. Run `manage.py refresh_directory` (from cron) to update it
+LDAP_DIRECTORY_FILTER = "(uid=*)"
+# the number of entries to fetch per LDAP request when copying the directory
+LDAP_PAGE_SIZE = 500
 
 #
 # Email
@@ -121,6 +182,40 @@ ELASTICSEARCH_CONNECTIONS = {
     }
 }
 
+# the number of documents to send to Elasticsearch per bulk request
+ELASTICSEARCH_CHUNK_SIZE = 500
+# the number of threads sending bulk requests when the whole index is rebuilt
+ELASTICSEARCH_REBUILD_THREADS = 4
+
+#
+# Caching
+#
+
+# the cache is shared by every process, so invalidating something (like a
+# bib's availability, or the autocomplete results) is seen everywhere.
+# Memcached evicts the least recently used keys when it fills up
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': variable("MEMCACHED_LOCATION", default='127.0.0.1:11211'),
+        'KEY_PREFIX': 'alma',
+    }
+}
+
+# how the items autocomplete finds Bibs by name. "match" does a scored search
+# on the edge ngrams of the names, "suggest" uses the completion suggester
+# (which is faster, but only matches the beginning of words). Rebuild the index
+# (manage.py rebuild_search_index) before switching to "suggest"
+AUTOCOMPLETE_MODE = "match"
+# how long to cache the results of an items autocomplete query. The cache is
+# invalidated whenever syncing the catalog changes something
+AUTOCOMPLETE_CACHE_TIMEOUT = 60*60
+# barcodes, mms_ids and the beginnings of words in Bib names are looked up in
+# an in-process copy of the catalog (see alma.items.catalog), and
+# Elasticsearch is only searched when that finds nothing. Set this to False
+# to always use Elasticsearch
+AUTOCOMPLETE_IN_MEMORY = True
+
 #
 # UI
 #
@@ -145,6 +240,8 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    # for the range field on Requests
+    'django.contrib.postgres',
     # 'debug_toolbar',
     'permissions',
     'arcutils',
@@ -153,6 +250,7 @@ INSTALLED_APPS = (
     'alma.items',
     'alma.requests',
     'alma.loans',
+    'alma.outbox',
 )
 
 MIDDLEWARE_CLASSES = (
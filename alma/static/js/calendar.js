@@ -137,9 +137,11 @@ $(document).ready(function(){
         e.preventDefault();
         var form = $(this);
         var url = form.attr('action');
-        $.post(url, form.serialize(), function(){
+        $.post(url, form.serialize()).fail(function(){
+            alert("Some of the reservations couldn't be cancelled in Alma. Please try again.");
+        }).always(function(){
             $('body').trigger("calendar:reload");
-        })
+        });
     });
 
     // whenever the username or item fields change, redraw the calendar to
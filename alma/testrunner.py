@@ -14,6 +14,12 @@ class TestRunner(SearchRunner):
         media_root = tempfile.mkdtemp()
         settings.MEDIA_ROOT = media_root
         settings.CELERY_ALWAYS_EAGER = True
+        # don't depend on (or pollute) memcached
+        settings.CACHES = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            }
+        }
         settings.PASSWORD_HASHERS = (
             'django.contrib.auth.hashers.MD5PasswordHasher',
         )
@@ -0,0 +1,353 @@
+import time
+from datetime import timedelta
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from model_mommy.mommy import make
+
+from . import api
+from .items.models import Bib, Item
+from .utils.metrics import Registry
+
+
+class GetSessionTest(TestCase):
+    def test_session_is_reused(self):
+        self.assertIs(api.get_session(), api.get_session())
+
+    def test_new_session_after_fork(self):
+        session = api.get_session()
+        with patch("alma.api.os.getpid", return_value=-1):
+            self.assertIsNot(session, api.get_session())
+
+    def test_request_goes_through_the_session(self):
+        session = Mock()
+        session.request.return_value = Mock(status_code=204, content=b"")
+        with patch("alma.api.get_session", return_value=session):
+            self.assertTrue(api.delete("almaws/v1/bibs/1/requests/2"))
+
+        args, kwargs = session.request.call_args
+        self.assertEqual(args, ("DELETE", api.BASE_URL + "almaws/v1/bibs/1/requests/2"))
+        self.assertEqual(kwargs['headers']['content-type'], "application/json")
+
+    def test_bodies_that_are_not_json_are_logged(self):
+        session = Mock()
+        session.request.return_value = Mock(status_code=502, content=b"<html>" + b"x" * 1000)
+        with patch("alma.api.get_session", return_value=session), patch("alma.api.logger") as logger:
+            self.assertRaises(ValueError, api.get, "almaws/v1/bibs/1/holdings")
+
+        args = logger.warning.call_args[0]
+        self.assertEqual(args[1], "alma:GET almaws/v1/bibs/{id}/holdings")
+        # the body is truncated
+        self.assertEqual(len(args[3]), 500)
+
+
+class ConcurrentMapTest(TestCase):
+    def test_results_are_in_order(self):
+        def slow_square(n):
+            # make the earlier calls finish last
+            time.sleep((5 - n) / 100)
+            return n * n
+
+        self.assertEqual(api.concurrent_map(slow_square, range(5)), [0, 1, 4, 9, 16])
+
+    def test_exceptions_are_raised(self):
+        def explode(n):
+            raise ValueError(n)
+
+        self.assertRaises(ValueError, api.concurrent_map, explode, range(3))
+
+
+class EndpointNameTest(TestCase):
+    def test(self):
+        self.assertEqual(api.endpoint_name("almaws/v1/bibs/99902460728301853/requests"), "almaws/v1/bibs/{id}/requests")
+        self.assertEqual(api.endpoint_name("almaws/v1/users/mdj2/loans"), "almaws/v1/users/{id}/loans")
+        self.assertEqual(api.endpoint_name("almaws/v1/conf/libraries"), "almaws/v1/conf/libraries")
+        # usernames don't have to have digits
+        self.assertEqual(api.endpoint_name("almaws/v1/users/mdj/loans"), "almaws/v1/users/{id}/loans")
+        self.assertEqual(
+            api.endpoint_name("almaws/v1/bibs/abc/holdings/def/items/ghi"),
+            "almaws/v1/bibs/{id}/holdings/{id}/items/{id}",
+        )
+
+
+class RegistryTest(TestCase):
+    def test_record(self):
+        registry = Registry()
+        registry.record("foo", .02, size=10)
+        registry.record("foo", 3, size=5, error=True)
+        timing = registry.snapshot()['timings']['foo']
+        self.assertEqual(timing['calls'], 2)
+        self.assertEqual(timing['errors'], 1)
+        self.assertEqual(timing['bytes'], 15)
+        self.assertEqual(timing['histogram']['<=0.025'], 1)
+        self.assertEqual(timing['histogram']['<=5'], 1)
+
+    def test_timer_records_errors(self):
+        registry = Registry()
+        with self.assertRaises(ValueError):
+            with registry.timer("foo"):
+                raise ValueError()
+        self.assertEqual(registry.snapshot()['timings']['foo']['errors'], 1)
+
+    def test_incr(self):
+        registry = Registry()
+        registry.incr("hits")
+        registry.incr("hits", 2)
+        self.assertEqual(registry.snapshot()['counters'], {"hits": 3})
+
+
+class GetAvailabilityTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_shorter_windows_are_served_from_the_cache(self):
+        with patch("alma.api.get", return_value={"booking_availability": None}) as get:
+            api.get_availability("1", 30)
+            api.get_availability("1", 10)
+            self.assertEqual(get.call_count, 1)
+            # at least ALMA_AVAILABILITY_MIN_DAYS are fetched
+            self.assertEqual(get.call_args[0][1]['period'], 180)
+
+            # a longer window than what's cached needs a new call
+            api.get_availability("1", 365)
+            self.assertEqual(get.call_count, 2)
+
+            # other bibs aren't cached
+            api.get_availability("2", 10)
+            self.assertEqual(get.call_count, 3)
+
+    def test_bookings_invalidate_the_cache(self):
+        with patch("alma.api.get", return_value={"booking_availability": None}) as get:
+            api.get_availability("1", 10)
+            with patch("alma.api.post", return_value={"request_id": "2"}):
+                api.create_booking("foo", "1", None, None)
+            api.get_availability("1", 10)
+            self.assertEqual(get.call_count, 2)
+
+            with patch("alma.api.delete", return_value=True):
+                api.delete_booking("2", "1")
+            api.get_availability("1", 10)
+            self.assertEqual(get.call_count, 3)
+
+
+class IsAvailableTest(TestCase):
+    def test(self):
+        start = now().replace(microsecond=0) + timedelta(days=1)
+        hour = timedelta(hours=1)
+        response = {"booking_availability": [
+            # Alma doesn't sort these
+            {"from_time": api.default(start + 5*hour), "to_time": api.default(start + 6*hour)[:-1] + ".000Z"},
+            {"from_time": api.default(start), "to_time": api.default(start + 3*hour)},
+        ]}
+        intervals = [
+            # overlaps the first booking
+            (start + 2*hour, start + 4*hour),
+            # between the bookings
+            (start + 3*hour, start + 5*hour),
+            # inside the second booking
+            (start + 5*hour, start + 5*hour + timedelta(minutes=1)),
+            # after everything
+            (start + 6*hour, start + 7*hour),
+            # out of order, and before everything
+            (start - hour, start),
+        ]
+        with patch("alma.api.get_availability", return_value=response):
+            self.assertEqual(list(api.is_available("1", intervals)), [False, True, False, True, True])
+
+        with patch("alma.api.get_availability", return_value={"booking_availability": None}):
+            self.assertEqual(list(api.is_available("1", intervals)), [True] * 5)
+
+
+def report_page(rows, token=None, is_finished=True):
+    """Builds the XML for a page of an analytics report"""
+    xml = "<QueryResult>"
+    if token:
+        xml += "<ResumptionToken>" + token + "</ResumptionToken>"
+    xml += "<IsFinished>" + str(is_finished).lower() + "</IsFinished>"
+    xml += '<ResultXml><rowset xmlns="urn:schemas-microsoft-com:xml-analysis:rowset">'
+    for row in rows:
+        xml += "<Row>" + "".join("<Column{0}>{1}</Column{0}>".format(i, text) for i, text in enumerate(row)) + "</Row>"
+    xml += "</rowset></ResultXml></QueryResult>"
+    return {"anies": [xml]}
+
+
+class GetItemsTest(TestCase):
+    def test_pages_are_followed(self):
+        row = ["0", "1", "Camera", "AVS", "123", "A camera", "2", "Video"]
+        pages = [
+            report_page([row], token="abc", is_finished=False),
+            report_page([row[:6] + ["3"] + row[7:]]),
+        ]
+        with patch("alma.api.get", side_effect=pages) as get:
+            items = list(api.get_items())
+
+        self.assertEqual([item['item_id'] for item in items], ["2", "3"])
+        self.assertEqual(items[0]['name'], "Camera")
+        self.assertEqual(items[0]['barcode'], "123")
+        # the token from the first page is used to get the second, instead of
+        # running the report again
+        self.assertEqual(get.call_args_list[1][0][1]['token'], "abc")
+        self.assertNotIn("path", get.call_args_list[1][0][1])
+
+    def test_rows_are_yielded_as_pages_arrive(self):
+        row = ["0", "1", "Camera", "AVS", "123", "A camera", "2", "Video"]
+        with patch("alma.api.get", side_effect=[report_page([row], token="abc", is_finished=False)]) as get:
+            items = api.get_items()
+            next(items)
+            self.assertEqual(get.call_count, 1)
+
+
+class IterReportTest(TestCase):
+    def test_running_reports_are_polled_with_backoff(self):
+        row = ["0", "1"]
+        pages = [
+            report_page([], token="abc", is_finished=False),
+            report_page([], is_finished=False),
+            report_page([], is_finished=False),
+            report_page([row]),
+        ]
+        with patch("alma.api.get", side_effect=pages), patch("alma.api.time.sleep") as sleep:
+            self.assertEqual(list(api.iter_report("foo")), [{0: "0", 1: "1"}])
+
+        delays = [call[0][0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 3)
+        # each delay is between half and all of the (doubling) backoff
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(2**attempt / 2 <= delay <= 2**attempt)
+
+    def test_timeout(self):
+        with patch("alma.api.get", return_value=report_page([], token="abc", is_finished=False)), patch("alma.api.time.sleep"):
+            with self.assertRaises(api.ReportTimeout):
+                list(api.iter_report("foo", timeout=5))
+
+
+class UpdateItemsTest(TestCase):
+    def setUp(self):
+        # don't touch the search index
+        patcher = patch("alma.items.indexes.update_documents")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def row(self, item_id, mms_id="1", name="Camera", barcode="123"):
+        return {
+            "mms_id": mms_id,
+            "name": name,
+            "item_id": item_id,
+            "barcode": barcode,
+            "description": "A camera",
+            "category": "Video",
+            "library_code": "AVS",
+            "useless": "0",
+        }
+
+    def test_new_and_changed_rows_are_saved_in_bulk(self):
+        rows = [self.row("10", name="Old name", barcode="old"), self.row("11", name="Old name", barcode="124")]
+        with patch("alma.api.get_items", return_value=rows):
+            api.update_items()
+
+        rows = [
+            self.row("10", name="Camera"),
+            self.row("11", name="Camera", barcode="124"),
+            self.row("12", mms_id="2", name="Tripod", barcode="125"),
+        ]
+        result = api.SyncResult()
+        with CaptureQueriesContext(connection) as context:
+            api.update_item_batch(rows, result, {Bib: set(), Item: set()})
+
+        # load the bib fingerprints, insert and update the bibs, then do the
+        # same for the items
+        self.assertEqual(len(context.captured_queries), 6)
+        self.assertEqual(Bib.objects.get(pk="1").name, "Camera")
+        self.assertEqual(Bib.objects.get(pk="2").name, "Tripod")
+        self.assertEqual(Item.objects.get(pk="10").barcode, "123")
+        self.assertEqual(Item.objects.get(pk="12").bib_id, "2")
+        self.assertEqual(result.created_bibs, {"2"})
+        self.assertEqual(result.updated_bibs, {"1"})
+        self.assertEqual(result.created_items, {"12"})
+        # item 11 didn't change
+        self.assertEqual(result.updated_items, {"10"})
+
+    def test_unchanged_rows_are_not_written(self):
+        rows = [self.row("10"), self.row("11", barcode="124")]
+        with patch("alma.api.get_items", return_value=rows):
+            api.update_items()
+            result = api.update_items()
+
+        self.assertFalse(result)
+        self.assertEqual(result.rows, 2)
+
+    def test_missing_rows_are_withdrawn_and_restored(self):
+        with patch("alma.api.get_items", return_value=[self.row("10"), self.row("11", mms_id="2", barcode="124")]):
+            api.update_items()
+
+        with patch("alma.api.get_items", return_value=[self.row("10")]):
+            with patch("alma.items.signals.catalog_synced.send") as send:
+                result = api.update_items()
+
+        self.assertEqual(result.withdrawn_items, {"11"})
+        self.assertEqual(result.withdrawn_bibs, {"2"})
+        self.assertNotEqual(Item.objects.get(pk="11").withdrawn_on, None)
+        self.assertEqual(Item.objects.get(pk="10").withdrawn_on, None)
+        send.assert_called_once_with(sender=None, result=result)
+
+        # when it comes back, it isn't withdrawn anymore
+        with patch("alma.api.get_items", return_value=[self.row("10"), self.row("11", mms_id="2", barcode="124")]):
+            result = api.update_items()
+
+        self.assertEqual(result.updated_items, {"11"})
+        self.assertEqual(Item.objects.get(pk="11").withdrawn_on, None)
+
+    def test_an_empty_report_withdraws_nothing(self):
+        with patch("alma.api.get_items", return_value=[self.row("10")]):
+            api.update_items()
+
+        with patch("alma.api.get_items", return_value=[]):
+            result = api.update_items()
+
+        self.assertEqual(result.withdrawn_items, set())
+        self.assertEqual(Item.objects.get(pk="10").withdrawn_on, None)
+
+    def test_dry_run_changes_nothing(self):
+        with patch("alma.api.get_items", return_value=[self.row("10")]):
+            with patch("alma.items.signals.catalog_synced.send") as send:
+                result = api.update_items(dry_run=True)
+
+        self.assertEqual(result.created_items, {"10"})
+        self.assertEqual(Item.objects.count(), 0)
+        self.assertFalse(send.called)
+
+
+class ReturnLoanTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        make(Item, item_id="10", bib=make(Bib, mms_id="1"))
+
+    def test_saved_holding_is_used(self):
+        with patch("alma.api.get_holdings") as get_holdings, patch("alma.api.scan_in") as scan_in:
+            api.return_loan("1", "10", holding_id="5")
+        self.assertFalse(get_holdings.called)
+        scan_in.assert_called_once_with("1", "5", "10")
+
+    def test_holding_is_looked_up_and_saved(self):
+        with patch("alma.api.get_holdings", return_value={"holding": [{"holding_id": "6"}]}), patch("alma.api.scan_in") as scan_in:
+            api.return_loan("1", "10")
+        scan_in.assert_called_once_with("1", "6", "10")
+        self.assertEqual(Item.objects.get(pk="10").holding_id, "6")
+
+    def test_stale_holding_is_refreshed(self):
+        with patch("alma.api.get_holdings", return_value={"holding": [{"holding_id": "6"}]}) as get_holdings:
+            with patch("alma.api.scan_in", side_effect=[api.AlmaError("no such holding"), {}]) as scan_in:
+                api.return_loan("1", "10", holding_id="5")
+        self.assertEqual(get_holdings.call_count, 1)
+        self.assertEqual(scan_in.call_args[0], ("1", "6", "10"))
+        self.assertEqual(Item.objects.get(pk="10").holding_id, "6")
+
+    def test_loans_save_the_holding(self):
+        Item.objects.filter(pk="10").update(barcode="123")
+        with patch("alma.api.post", return_value={"loan_id": "1", "holding_id": "7"}):
+            api.create_loan("mdj2", "123")
+        self.assertEqual(Item.objects.get(pk="10").holding_id, "7")
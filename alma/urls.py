@@ -4,8 +4,10 @@ from django.conf.urls.static import static
 from django.contrib import admin
 
 from .items import views as items
+from .outbox import views as outbox
 from .requests import views as requests
 from .users import views as users
+from .utils import views as utils
 
 admin.autodiscover()
 
@@ -33,6 +35,10 @@ urlpatterns = patterns(
 
     url(r'^users/autocomplete/?$', users.autocomplete, name='users-autocomplete'),
 
+    url(r'^outbox/status/?$', outbox.status, name='outbox-status'),
+
+    url(r'^metrics/?$', utils.metrics, name='metrics'),
+
     # these url routes are useful for password reset functionality and logging in and out
     # https://github.com/django/django/blob/master/django/contrib/auth/urls.py
     # url(r'', include('django.contrib.auth.urls')),
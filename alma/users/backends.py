@@ -1,31 +1,63 @@
 from arcutils import ldap
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.utils.timezone import now
 from djangocas.backends import CASBackend
 
+from alma.utils.metrics import registry
+
 from .models import User
+from .utils import cached_ldapsearch
 
 LOGIN_GROUPS = ['arc']
 
 
 class PSUBackend(CASBackend):
     def get_or_init_user(self, username):
-        # make sure this user is in the required group
-        groups = self.get_groups(username)
-        if set(groups) & set(LOGIN_GROUPS) == set():
-            raise PermissionDenied("You need to belong to a group in LOGIN_GROUPS")
-
-        email = username + "@pdx.edu"
-        try:
-            user = User.objects.get(email=email)
-        except User.DoesNotExist:
-            profile = self.get_profile(username)
-            user = User(email=email, first_name=profile['first_name'], last_name=profile['last_name'], is_active=True, is_staff=False, last_login=now())
-            user.set_unusable_password()
-            user.save()
+        # the time spent in LDAP and the database is recorded separately, so
+        # slow logins can be blamed on the right thing
+        with registry.timer("login:total"):
+            with registry.timer("login:ldap"):
+                groups, profile = self.get_groups_and_profile(username)
+
+            # make sure this user is in the required group
+            if set(groups) & set(LOGIN_GROUPS) == set():
+                raise PermissionDenied("You need to belong to a group in LOGIN_GROUPS")
+
+            with registry.timer("login:db"):
+                email = username + "@pdx.edu"
+                try:
+                    user = User.objects.get(email=email)
+                except User.DoesNotExist:
+                    if profile is None:
+                        profile = self.get_profile(username)
+                    user = User(email=email, first_name=profile['first_name'], last_name=profile['last_name'], is_active=True, is_staff=False, last_login=now())
+                    user.set_unusable_password()
+                    user.save()
 
         return user
 
+    def get_groups_and_profile(self, username):
+        """
+        Finds the user's entry and the groups they are in with one LDAP search.
+        The results are cached for LDAP_GROUP_CACHE_TIMEOUT seconds, so
+        everyone logging in at once (at the start of a term) doesn't pile up
+        on LDAP.
+
+        Returns a (groups, profile) tuple. The profile is None if the user's
+        entry wasn't found
+        """
+        q = ldap.escape(username)
+        results = cached_ldapsearch("(| (uid=" + q + ") (& (memberUid=" + q + ") (cn=*)))", timeout=settings.LDAP_GROUP_CACHE_TIMEOUT)
+        groups = []
+        profile = None
+        for dn, entry in results:
+            if username in entry.get('memberUid', []):
+                groups.append(entry['cn'][0])
+            elif username in entry.get('uid', []):
+                profile = ldap.parse_profile(entry)
+        return groups, profile
+
     def get_profile(self, username):
         results = ldap.ldapsearch("(uid=" + ldap.escape(username) + ")")
         dn, entry = results[0]
@@ -35,9 +67,7 @@ class PSUBackend(CASBackend):
     def get_groups(self, username):
         """
         Method to get the groups the user is involved in.
-        Calls an LDAP search.
         Returns a list of groups.
         """
-        results = ldap.ldapsearch("(& (memberUid=" + ldap.escape(username) + ") (cn=*))")
-        groups = [result[1]['cn'][0] for result in results]
+        groups, profile = self.get_groups_and_profile(username)
         return groups
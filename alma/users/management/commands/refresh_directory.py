@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from alma.users.utils import refresh_directory
+from alma.utils import LockNotAcquired, advisory_lock
+
+
+class Command(BaseCommand):
+    help = "Copies the usernames and names of the people in LDAP into the local directory used by the users autocomplete"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-size", type=int, default=None, help="The number of LDAP entries to fetch per request")
+
+    def handle(self, *args, page_size, **options):
+        start = time.monotonic()
+        try:
+            with advisory_lock("alma.users.refresh_directory"):
+                created, updated, deleted = refresh_directory(page_size=page_size)
+        except LockNotAcquired:
+            raise CommandError("Another refresh is already running")
+
+        self.stdout.write("Inserted: {0}, Updated: {1}, Deleted: {2} in {3:.1f}s".format(created, updated, deleted, time.monotonic() - start))
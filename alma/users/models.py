@@ -54,3 +54,40 @@ class User(AbstractBaseUser):
         allowed to cloak as another user
         """
         return self.is_staff
+
+
+class DirectoryEntry(models.Model):
+    """
+    A local copy of the people in LDAP (see alma.users.utils.refresh_directory),
+    so the users autocomplete is an indexed prefix lookup instead of an LDAP
+    search. Since the primary key is a varchar, Postgres gets a
+    varchar_pattern_ops index on it, which is what `odin__startswith` uses.
+    """
+    odin = models.CharField(max_length=255, primary_key=True)
+    first_name = models.CharField(max_length=255, blank=True)
+    last_name = models.CharField(max_length=255, blank=True)
+    email = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        db_table = "directory_entry"
+        ordering = ['odin']
+
+    def __str__(self):
+        return self.odin
+
+    @property
+    def full_name(self):
+        return (self.first_name + " " + self.last_name).strip()
+
+    def as_profile(self):
+        """
+        Returns a dict shaped like arcutils.ldap.parse_profile() output, which
+        is what the javascript expects
+        """
+        return {
+            "odin": self.odin,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "full_name": self.full_name,
+            "email": self.email,
+        }
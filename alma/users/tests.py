@@ -1,11 +1,19 @@
+import json
 from datetime import date
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
-from django.test import TestCase
-from model_mommy.mommy import prepare
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.test import RequestFactory, TestCase
+from ldap3.core.exceptions import LDAPException
+from model_mommy.mommy import make, prepare
 
-from .models import User
-from .utils import is_ldap_user
+from alma.utils.metrics import registry
+
+from .backends import PSUBackend
+from .models import DirectoryEntry, User
+from .utils import close_connection, is_ldap_user, ldapsearch, refresh_directory
+from .views import autocomplete
 
 thing = lambda date, repeat_on: (2**((date.weekday()+1) % 7)) & repeat_on
 
@@ -22,12 +30,106 @@ class TestThing(TestCase):
 
 
 class IsLdapUserTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
     def test(self):
         with patch("alma.users.utils.ldapsearch", return_value=['mdj2']):
             self.assertTrue(is_ldap_user("mdj2"))
         with patch("alma.users.utils.ldapsearch", return_value=[]):
             self.assertFalse(is_ldap_user("mdj2222"))
 
+    def test_results_are_cached(self):
+        with patch("alma.users.utils.ldapsearch", return_value=['mdj2']) as ldapsearch:
+            self.assertTrue(is_ldap_user("mdj2"))
+            self.assertTrue(is_ldap_user("mdj2"))
+            self.assertEqual(ldapsearch.call_count, 1)
+
+        # misses are cached too, just not for as long
+        with patch("alma.users.utils.ldapsearch", return_value=[]) as ldapsearch, patch("alma.users.utils.cache.set") as cache_set:
+            self.assertFalse(is_ldap_user("mdj2222"))
+            self.assertEqual(cache_set.call_args[0][2], 60*5)
+
+
+def ldap_entry(uid, first_name, last_name):
+    return ("uid=" + uid, {"uid": [uid], "givenName": [first_name], "sn": [last_name], "mail": [uid + "@pdx.edu"]})
+
+
+def parse_profile(entry):
+    return {"first_name": entry['givenName'][0], "last_name": entry['sn'][0], "email": entry['mail'][0]}
+
+
+class DirectoryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = patch("alma.users.utils.parse_profile", side_effect=parse_profile)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refresh_directory(self):
+        make(DirectoryEntry, odin="mdj2", first_name="Matt", last_name="Johnson", email="mdj2@pdx.edu")
+        make(DirectoryEntry, odin="foo", first_name="Foo", last_name="Bar", email="foo@pdx.edu")
+        make(DirectoryEntry, odin="gone", first_name="Gone", last_name="Away", email="gone@pdx.edu")
+        entries = [
+            ldap_entry("mdj2", "Matt", "Johnson"),
+            ldap_entry("foo", "Foo", "Baz"),
+            ldap_entry("new", "New", "Person"),
+        ]
+        with patch("alma.users.utils.iter_ldapsearch", return_value=iter(entries)):
+            self.assertEqual(refresh_directory(batch_size=2), (1, 1, 1))
+
+        self.assertEqual(list(DirectoryEntry.objects.values_list("odin", flat=True)), ["foo", "mdj2", "new"])
+        self.assertEqual(DirectoryEntry.objects.get(pk="foo").last_name, "Baz")
+
+    def test_nothing_is_deleted_when_ldap_returns_nothing(self):
+        make(DirectoryEntry, odin="mdj2")
+        with patch("alma.users.utils.iter_ldapsearch", return_value=iter([])):
+            self.assertEqual(refresh_directory(), (0, 0, 0))
+        self.assertEqual(DirectoryEntry.objects.count(), 1)
+
+    def test_autocomplete_uses_the_directory(self):
+        make(DirectoryEntry, odin="mdj2", first_name="Matt", last_name="Johnson", email="mdj2@pdx.edu")
+        make(DirectoryEntry, odin="mdj3", first_name="Foo", last_name="Bar", email="mdj3@pdx.edu")
+        make(DirectoryEntry, odin="xyz", first_name="Foo", last_name="Bar", email="xyz@pdx.edu")
+        request = RequestFactory().get("/users/autocomplete", {"query": "MDJ"})
+        request.user = prepare(User)
+        with patch("alma.users.views.cached_ldapsearch") as cached_ldapsearch:
+            response = autocomplete(request)
+        self.assertFalse(cached_ldapsearch.called)
+        self.assertEqual(json.loads(response.content.decode()), [
+            {"odin": "mdj2", "first_name": "Matt", "last_name": "Johnson", "full_name": "Matt Johnson", "email": "mdj2@pdx.edu"},
+            {"odin": "mdj3", "first_name": "Foo", "last_name": "Bar", "full_name": "Foo Bar", "email": "mdj3@pdx.edu"},
+        ])
+
+    def test_is_ldap_user_checks_the_directory_first(self):
+        make(DirectoryEntry, odin="mdj2")
+        with patch("alma.users.utils.cached_ldapsearch") as cached_ldapsearch:
+            self.assertTrue(is_ldap_user("mdj2"))
+        self.assertFalse(cached_ldapsearch.called)
+
+
+class LdapsearchTest(TestCase):
+    def tearDown(self):
+        close_connection()
+
+    def test_connection_is_reused(self):
+        connection = Mock(closed=False, response=[
+            {"type": "searchResEntry", "dn": "uid=mdj2", "attributes": {"uid": ["mdj2"]}},
+            {"type": "searchResRef"},
+        ])
+        with patch("alma.users.utils.Connection", return_value=connection) as Connection:
+            self.assertEqual(ldapsearch("(uid=mdj2)"), [("uid=mdj2", {"uid": ["mdj2"]})])
+            ldapsearch("(uid=mdj2)")
+        self.assertEqual(Connection.call_count, 1)
+
+    def test_reconnect_when_the_connection_drops(self):
+        dropped = Mock(closed=False)
+        dropped.search.side_effect = LDAPException()
+        connection = Mock(closed=False, response=[])
+        with patch("alma.users.utils.Connection", side_effect=[dropped, connection]):
+            self.assertEqual(ldapsearch("(uid=mdj2)"), [])
+        self.assertTrue(dropped.unbind.called)
+
 
 class UserTest(TestCase):
     """
@@ -72,3 +174,31 @@ class UserTest(TestCase):
 
         user = prepare(User, is_staff=True)
         self.assertTrue(user.has_module_perms("foo"), user)
+
+
+class PSUBackendTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+
+    def test_groups_and_profile_come_from_one_cached_search(self):
+        results = [
+            ("cn=arc", {"cn": ["arc"], "memberUid": ["mdj2", "foo"]}),
+            ("uid=mdj2", {"uid": ["mdj2"], "cn": ["Matt Johnson"]}),
+        ]
+        profile = {"first_name": "Matt", "last_name": "Johnson"}
+        with patch("alma.users.utils.ldapsearch", return_value=results) as ldapsearch, patch("alma.users.backends.ldap.parse_profile", return_value=profile):
+            user = PSUBackend().get_or_init_user("mdj2")
+            self.assertEqual(user.first_name, "Matt")
+            self.assertEqual(PSUBackend().get_or_init_user("mdj2"), user)
+
+        self.assertEqual(ldapsearch.call_count, 1)
+        timings = registry.snapshot()['timings']
+        for name in ["login:total", "login:ldap", "login:db"]:
+            self.assertEqual(timings[name]['calls'], 2)
+
+    def test_login_group_is_required(self):
+        results = [("uid=mdj2", {"uid": ["mdj2"]})]
+        with patch("alma.users.utils.ldapsearch", return_value=results), patch("alma.users.backends.ldap.parse_profile"):
+            self.assertRaises(PermissionDenied, PSUBackend().get_or_init_user, "mdj2")
+        self.assertEqual(User.objects.count(), 0)
@@ -1,10 +1,182 @@
-from arcutils.ldap import escape, ldapsearch
+import hashlib
+import os
+import threading
+
+from arcutils.ldap import escape, parse_profile
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from ldap3 import ALL_ATTRIBUTES, SEARCH_SCOPE_WHOLE_SUBTREE, Connection, Server
+from ldap3.core.exceptions import LDAPException
+
+from alma.utils import bulk_update, chunked
+from alma.utils.metrics import registry
+
+from .models import DirectoryEntry
+
+# each thread keeps its own LDAP connections open (ldap3 connections can't be
+# shared between threads), keyed by the name of the connection in
+# settings.LDAP. The pid is remembered so a forked process doesn't reuse its
+# parent's sockets
+_local = threading.local()
+
+
+def get_connection(using="default"):
+    """
+    Returns this thread's bound connection to the LDAP server, opening it if
+    needed
+    """
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.connections = {}
+        _local.pid = os.getpid()
+
+    connection = _local.connections.get(using)
+    if connection is None or connection.closed:
+        connection = Connection(Server(settings.LDAP[using]['host']), auto_bind=True)
+        _local.connections[using] = connection
+    return connection
+
+
+def close_connection(using="default"):
+    connection = getattr(_local, "connections", {}).pop(using, None)
+    if connection is not None:
+        try:
+            connection.unbind()
+        except LDAPException:
+            pass
+
+
+def ldapsearch(query, using="default", size_limit=0):
+    """
+    Like arcutils.ldap.ldapsearch (it returns a list of (dn, attributes)
+    tuples), except the connection is kept open between searches. If the
+    server dropped the connection, we reconnect and try again once
+    """
+    for attempt in range(2):
+        connection = get_connection(using)
+        try:
+            with registry.timer("ldap:search"):
+                connection.search(settings.LDAP[using]['search_dn'], query, SEARCH_SCOPE_WHOLE_SUBTREE, attributes=ALL_ATTRIBUTES, size_limit=size_limit)
+            break
+        except LDAPException:
+            close_connection(using)
+            if attempt:
+                raise
+
+    return [(result['dn'], dict(result['attributes'])) for result in connection.response or [] if result['type'] == "searchResEntry"]
+
+
+def cached_ldapsearch(query, using="default", size_limit=0, timeout=None):
+    """
+    Returns the results of ldapsearch() from the cache, or does the search and
+    caches the results. Searches that found something are cached for
+    `timeout` (or LDAP_CACHE_TIMEOUT) seconds, and searches that didn't for
+    LDAP_NEGATIVE_CACHE_TIMEOUT seconds (so a new account shows up soon)
+    """
+    # memcached doesn't allow spaces (or long keys), so the query is hashed
+    key = "ldap:{using}:{size_limit}:{query}".format(
+        using=using,
+        size_limit=size_limit,
+        query=hashlib.sha1(query.encode()).hexdigest(),
+    )
+    results = cache.get(key)
+    if results is not None:
+        registry.incr("ldap_cache:hit")
+        return results
+
+    registry.incr("ldap_cache:miss")
+    results = ldapsearch(query, using=using, size_limit=size_limit)
+    if timeout is None:
+        timeout = settings.LDAP_CACHE_TIMEOUT
+    cache.set(key, results, timeout if results else settings.LDAP_NEGATIVE_CACHE_TIMEOUT)
+    return results
 
 
 def is_ldap_user(username):
     """
-    Checks LDAP to ensure a user name exists.
+    Checks LDAP to ensure a user name exists. The local copy of the directory
+    is checked first, so LDAP is only searched for accounts created since the
+    last refresh_directory()
     """
+    if DirectoryEntry.objects.filter(odin=username).exists():
+        return True
+
     q = escape(username)
     search = '(uid={q})'.format(q=q)
-    return bool(ldapsearch(search))
+    return bool(cached_ldapsearch(search))
+
+
+def iter_ldapsearch(query, using="default", page_size=500):
+    """
+    Yields the (dn, attributes) tuples for a search that finds too many
+    entries for the server to return at once, a page at a time (using the
+    simple paged results control)
+    """
+    connection = get_connection(using)
+    cookie = None
+    while True:
+        with registry.timer("ldap:search"):
+            connection.search(
+                settings.LDAP[using]['search_dn'],
+                query,
+                SEARCH_SCOPE_WHOLE_SUBTREE,
+                attributes=ALL_ATTRIBUTES,
+                paged_size=page_size,
+                paged_cookie=cookie,
+            )
+        for result in connection.response or []:
+            if result['type'] == "searchResEntry":
+                yield result['dn'], dict(result['attributes'])
+
+        cookie = connection.result.get('controls', {}).get('1.2.840.113556.1.4.319', {}).get('value', {}).get('cookie')
+        if not cookie:
+            break
+
+
+def refresh_directory(page_size=None, batch_size=1000):
+    """
+    Copies the people matching settings.LDAP_DIRECTORY_FILTER into the
+    DirectoryEntry table. Entries that changed are updated in bulk, and
+    entries that aren't in LDAP anymore are deleted (unless LDAP returned
+    nothing at all, which is more likely an outage than everyone leaving).
+
+    Returns a (created, updated, deleted) tuple of counts
+    """
+    fields = ["first_name", "last_name", "email"]
+    created = updated = deleted = 0
+    seen = set()
+    results = iter_ldapsearch(settings.LDAP_DIRECTORY_FILTER, page_size=page_size or settings.LDAP_PAGE_SIZE)
+    for batch in chunked(results, batch_size):
+        entries = {}
+        for dn, attributes in batch:
+            if not attributes.get('uid'):
+                continue
+            profile = parse_profile(attributes)
+            odin = attributes['uid'][0]
+            entries[odin] = DirectoryEntry(
+                odin=odin,
+                first_name=profile.get('first_name') or "",
+                last_name=profile.get('last_name') or "",
+                email=profile.get('email') or "",
+            )
+        seen.update(entries)
+
+        existing = dict((row[0], row[1:]) for row in DirectoryEntry.objects.filter(pk__in=list(entries)).values_list("pk", *fields))
+        new = [entry for odin, entry in entries.items() if odin not in existing]
+        changed = [
+            entry for odin, entry in entries.items()
+            if odin in existing and existing[odin] != tuple(getattr(entry, field) for field in fields)
+        ]
+        with transaction.atomic():
+            DirectoryEntry.objects.bulk_create(new)
+            bulk_update(changed, fields)
+        created += len(new)
+        updated += len(changed)
+
+    if seen:
+        gone = set(DirectoryEntry.objects.values_list("pk", flat=True)) - seen
+        for odins in chunked(gone, batch_size):
+            DirectoryEntry.objects.filter(pk__in=odins).delete()
+        deleted = len(gone)
+
+    return created, updated, deleted
@@ -1,26 +1,35 @@
-from arcutils.ldap import escape, ldapsearch, parse_profile
+from arcutils.ldap import escape, parse_profile
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 
+from .models import DirectoryEntry
+from .utils import cached_ldapsearch
+
 
 @login_required
 def autocomplete(request):
     """
-    Does an LDAP search and returns a JSON array of objects
+    Looks up the usernames starting with the query in the local copy of the
+    directory (see alma.users.utils.refresh_directory) and returns a JSON
+    array of objects. Until the directory has been copied, LDAP is searched
+    instead
     """
-    q = escape(request.GET.get('query', ""))
+    q = request.GET.get('query', "").strip().lower()
     if len(q) < 3:
         return JsonResponse([], safe=False)
 
     # only return a handful of results
     MAX_RESULTS = 5
 
-    search = '(uid={q}*)'.format(q=q)
-    results = ldapsearch(search, size_limit=MAX_RESULTS)
-    # I don't think LDAP guarantees the sort order, so we have to sort ourselves
-    results.sort(key=lambda o: o[1]['uid'][0])
-    output = []
+    entries = DirectoryEntry.objects.filter(odin__startswith=q).order_by("odin")[:MAX_RESULTS]
+    output = [entry.as_profile() for entry in entries]
+    if output or DirectoryEntry.objects.exists():
+        return JsonResponse(output, safe=False)
 
+    search = '(uid={q}*)'.format(q=escape(q))
+    results = cached_ldapsearch(search, size_limit=MAX_RESULTS)
+    # I don't think LDAP guarantees the sort order, so we have to sort ourselves
+    results = sorted(results, key=lambda o: o[1]['uid'][0])
     for result in results[:MAX_RESULTS]:
         output.append(parse_profile(result[1]))
 
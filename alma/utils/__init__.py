@@ -1,6 +1,86 @@
+import hashlib
+from contextlib import contextmanager
+from itertools import islice
+
+from django.db import connection
 from django.db.models import Manager
 
 
 class ImpotentManager(Manager):
     def delete(self, *args, **kwargs):
         raise RuntimeError("You need to call the delete() method on each object in the queryset")
+
+
+class LockNotAcquired(Exception):
+    """
+    Raised by advisory_lock() when another process holds the lock
+    """
+
+
+@contextmanager
+def advisory_lock(name):
+    """
+    Holds the Postgres advisory lock called `name` for the body of the with
+    statement, so only one process (on any machine) can be running it at a
+    time. If another process has the lock, LockNotAcquired is raised right
+    away, instead of waiting for it.
+    """
+    # advisory locks are identified by a bigint
+    key = int(hashlib.md5(name.encode()).hexdigest()[:15], 16)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [key])
+        if not cursor.fetchone()[0]:
+            raise LockNotAcquired(name)
+
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [key])
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of (at most) `size` elements from the iterable, without
+    reading more of it than it needs to
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def bulk_update(objs, fields):
+    """
+    Saves the `fields` on every model instance in `objs` (which must all be
+    the same model) with a single UPDATE statement. No signals are sent.
+
+    This uses the Postgres UPDATE ... FROM (VALUES ...) syntax, since Django
+    doesn't have a way to do this
+    """
+    if not objs:
+        return 0
+
+    meta = type(objs[0])._meta
+    qn = connection.ops.quote_name
+    fields = [meta.pk] + [meta.get_field(name) for name in fields]
+
+    # the values are cast, because Postgres can't tell the types of the
+    # columns in a VALUES list on its own
+    row = "(" + ", ".join("%s::" + field.db_type(connection) for field in fields) + ")"
+    params = []
+    for obj in objs:
+        params.extend(field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields)
+
+    sql = "UPDATE {table} SET {assignments} FROM (VALUES {rows}) AS new_values ({columns}) WHERE {table}.{pk} = new_values.{pk}".format(
+        table=qn(meta.db_table),
+        assignments=", ".join("{0} = new_values.{0}".format(qn(field.column)) for field in fields[1:]),
+        rows=", ".join([row] * len(objs)),
+        columns=", ".join(qn(field.column) for field in fields),
+        pk=qn(meta.pk.column),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
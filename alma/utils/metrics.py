@@ -0,0 +1,105 @@
+"""
+In-process instrumentation. It is cheap enough to leave on in production:
+recording a measurement is a dict lookup, a bisect and a few additions under
+a lock.
+
+Timings are grouped by name (for Alma calls, the name is the endpoint with the
+IDs taken out, e.g. "almaws/v1/bibs/{id}/requests"). Each timing keeps a call
+count, an error count, the number of bytes received and a latency histogram.
+Counters are just named integers (cache hits and misses, for example).
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# the upper bounds (in seconds) of the buckets in the latency histograms
+BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float("inf"))
+
+
+class Timing:
+    """
+    The call count, error count, bytes and latency histogram for one name
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * len(BUCKETS)
+
+    def add(self, elapsed, size=0, error=False):
+        self.calls += 1
+        self.errors += bool(error)
+        self.bytes += size
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.histogram[bisect_left(BUCKETS, elapsed)] += 1
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "error_rate": self.errors / self.calls if self.calls else 0,
+            "bytes": self.bytes,
+            "total_time": self.total_time,
+            "mean_time": self.total_time / self.calls if self.calls else 0,
+            "max_time": self.max_time,
+            # the key is the upper bound of the bucket
+            "histogram": dict(("<=" + str(bound), count) for bound, count in zip(BUCKETS, self.histogram)),
+        }
+
+
+class Registry:
+    """
+    A thread-safe collection of Timings and counters
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+
+    def record(self, name, elapsed, size=0, error=False):
+        """Record one measurement for `name`. `elapsed` is in seconds"""
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.add(elapsed, size, error)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Times the body of the with statement. If it raises an exception, the
+        measurement counts as an error
+        """
+        start = time.monotonic()
+        error = False
+        try:
+            yield
+        except:  # noqa
+            error = True
+            raise
+        finally:
+            self.record(name, time.monotonic() - start, error=error)
+
+    def snapshot(self):
+        """Returns all the measurements as a JSON serializable dict"""
+        with self._lock:
+            return {
+                "timings": dict((name, timing.as_dict()) for name, timing in self.timings.items()),
+                "counters": dict(self.counters),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self.counters.clear()
+
+
+registry = Registry()
@@ -1,15 +1,16 @@
+from itertools import count
 from unittest.mock import Mock, patch
 
 from django.test import TestCase
 from elasticmodels.runner import ESTestCase
 
-id_counter = 0
+# next() on a count is atomic, so this is safe to call from the threads that
+# make Alma calls concurrently
+id_counter = count(1)
 
 
 def id_generator(*args, **kwargs):
-    global id_counter
-    id_counter += 1
-    return str(id_counter)
+    return str(next(id_counter))
 
 
 patches = [
@@ -0,0 +1,19 @@
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import PermissionDenied
+from django.http import JsonResponse
+
+from .metrics import registry
+
+
+@login_required
+def metrics(request):
+    """
+    Returns the instrumentation collected by this process as JSON
+    """
+    if not request.user.is_staff:
+        raise PermissionDenied()
+
+    if request.method == "POST" and request.POST.get("reset"):
+        registry.reset()
+
+    return JsonResponse(registry.snapshot())
@@ -27,3 +27,5 @@ DB_HOST = ''
 ALMA_API_KEY = 'abc123'
 
 ELASTICSEARCH_HOST = 'http://localhost:9200'
+
+MEMCACHED_LOCATION = '127.0.0.1:11211'